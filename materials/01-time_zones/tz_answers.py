@@ -3,6 +3,8 @@ from functools import total_ordering
 
 from dateutil import tz
 
+import tz_helpers
+
 UTC = timezone.utc
 
 
@@ -22,8 +24,7 @@ class UTC_(tzinfo):
 def now_in_zones(tz_list):
     # For now I'll fib and pretend the current datetime is 2020
     dt_utc = datetime(2020, 1, 1, tzinfo=tz.gettz('America/New_York'))
-    for tzstr in tz_list:
-        dt = dt_utc.astimezone(tz.gettz(tzstr))
+    for tzstr, dt in tz_helpers.in_zones(dt_utc, tz_list).items():
         print(f"{tzstr + ':':<25} {dt}")
 
 
@@ -44,10 +45,12 @@ def localize(dt, tzi, is_dst=False):
 
     if is_dst is None:
         # If is_dst is None, we want to raise an error for uncertain situations
+        # (tz_helpers versions of tz.datetime_ambiguous / tz.datetime_exists,
+        # which look the answer up in a cached index of the zone's transitions)
         dt_out = dt.replace(tzinfo=tzi)
-        if tz.datetime_ambiguous(dt_out):
+        if tz_helpers.datetime_ambiguous(dt_out):
             raise AmbiguousTimeError(f"Ambiguous time {dt} in zone {tzi}")
-        elif not tz.datetime_exists(dt_out):
+        elif not tz_helpers.datetime_exists(dt_out):
             raise NonExistentTimeError(f"Time {dt} does not exist in zone {tzi}")
     else:
         dt_out = dt.replace(fold=(not is_dst), tzinfo=tzi)
@@ -69,13 +72,14 @@ def wall_sub(dt: datetime, other: datetime) -> timedelta:
 
 def absolute_add(dt: datetime, offset: timedelta) -> datetime:
     """Addition with "absolute time" semantics"""
-    return (dt.astimezone(UTC) + offset).astimezone(dt.tzinfo)
+    # Equivalent to (dt.astimezone(UTC) + offset).astimezone(dt.tzinfo)
+    return tz_helpers.from_utc(tz_helpers.to_utc(dt) + offset, dt.tzinfo)
 
 def absolute_sub(dt: datetime, other: datetime) -> timedelta:
     if isinstance(other, timedelta):
         return absolute_add(dt, -1 * other)
 
-    return (dt.astimezone(UTC) - other.astimezone(UTC))
+    return tz_helpers.to_utc(dt) - tz_helpers.to_utc(other)
 
 ### Exercise (bonus): Implement a `AbsoluteDateTime` and `WallDateTime`
 class ExplicitSemanticsDatetime(datetime):
@@ -92,9 +96,35 @@ class ExplicitSemanticsDatetime(datetime):
                    tzinfo=dt.tzinfo, fold=dt.fold)
 
 
+_UTC_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+
+def _utc_key(dt):
+    if isinstance(dt, AbsoluteDateTime):
+        return dt.utc_key
+
+    return tz_helpers.to_utc_us(dt)
+
+
 @total_ordering
 class AbsoluteDateTime(ExplicitSemanticsDatetime):
     """A version of datetime that uses only elapsed time semantics"""
+    @property
+    def utc_key(self):
+        """
+        Microseconds since the epoch in UTC, used for comparisons and hashing.
+
+        This is calculated the first time it's needed and then cached, so
+        sorting a list of these doesn't look up the UTC offset over and over
+        again. (For naive datetimes, it's fixed to the local zone at the time
+        of the first comparison.)
+        """
+        try:
+            return self._utc_key
+        except AttributeError:
+            self._utc_key = tz_helpers.to_utc_us(self)
+            return self._utc_key
+
     def __add__(self, other):
         # __add__ is only supported between datetime and timedelta
         dt = datetime.__add__(self.astimezone(UTC), other)
@@ -109,14 +139,24 @@ class AbsoluteDateTime(ExplicitSemanticsDatetime):
             # Use __add__ implementation if it's datetime and timedelta
             return self + (-1) * other
         else:
-            return datetime.__sub__(self.astimezone(UTC),
-                                    other.astimezone(UTC))
+            return timedelta(microseconds=self.utc_key - _utc_key(other))
 
     def __eq__(self, other):
-        return datetime.__eq__(self.astimezone(UTC), other.astimezone(UTC))
+        if not isinstance(other, datetime):
+            return NotImplemented
+
+        return self.utc_key == _utc_key(other)
 
     def __lt__(self, other):
-        return datetime.__lt__(self.astimezone(UTC), other.astimezone(UTC))
+        if not isinstance(other, datetime):
+            return NotImplemented
+
+        return self.utc_key < _utc_key(other)
+
+    def __hash__(self):
+        # Instances are equal to aware datetimes at the same instant, so they
+        # must hash the same way
+        return hash(_UTC_EPOCH + timedelta(microseconds=self.utc_key))
 
     def astimezone(self, tz):
             return datetime.astimezone(self.as_datetime(), tz)
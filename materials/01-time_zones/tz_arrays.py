@@ -0,0 +1,553 @@
+"""
+Bulk versions of some of the functions in ``tz_answers``, operating on NumPy
+arrays rather than on one ``datetime`` at a time.
+
+These are not part of the exercises, but they are useful when you need to
+apply the same time zone logic to millions of values.
+"""
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import numpy as np
+
+from dateutil import tz
+
+from tz_answers import AbsoluteDateTime, WallDateTime
+from tz_answers import AmbiguousTimeError, NonExistentTimeError, UTC
+from tz_helpers import get_transition_index, to_utc_us, to_wall_us
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+_ONE_US = timedelta(microseconds=1)
+_NAT = np.iinfo(np.int64).min
+
+_IS_DST_POLICIES = (True, False, None, "raise", "NaT", "shift_forward")
+
+
+### Bulk localization
+class LocalizedArray(NamedTuple):
+    """The result of localizing an array of naive datetimes"""
+    utc: np.ndarray             # datetime64[us]
+    utcoffset: np.ndarray       # timedelta64[us]
+    ambiguous: np.ndarray       # bool
+    nonexistent: np.ndarray     # bool
+
+
+def _as_wall_us(dts):
+    """Convert datetime64 arrays or sequences of naive datetimes to int64 us"""
+    if isinstance(dts, np.ndarray) and dts.dtype.kind == "M":
+        return dts.astype("datetime64[us]").view(np.int64)
+
+    dts = list(dts)
+    if any(getattr(dt, "tzinfo", None) is not None for dt in dts):
+        raise ValueError("localize can only be used with naive datetimes")
+
+    return np.array(dts, dtype="datetime64[us]").view(np.int64)
+
+
+def _localize_scalar(wall_us, tzi, fold, shift_forward):
+    """Fallback for zones without a transition table: probe each datetime"""
+    n = len(wall_us)
+    offsets = np.full(n, _NAT, dtype=np.int64)
+    ambiguous = np.zeros(n, dtype=bool)
+    nonexistent = np.zeros(n, dtype=bool)
+
+    for ii, us in enumerate(wall_us.tolist()):
+        if us == _NAT:
+            continue
+
+        dt = datetime(1970, 1, 1) + timedelta(microseconds=us)
+        dt = dt.replace(tzinfo=tzi, fold=fold)
+        ambiguous[ii] = tz.datetime_ambiguous(dt)
+        nonexistent[ii] = not tz.datetime_exists(dt)
+
+        if nonexistent[ii] and shift_forward:
+            dt = tz.resolve_imaginary(dt)
+            offsets[ii] = us - (dt - _EPOCH) // _ONE_US
+        else:
+            offsets[ii] = dt.utcoffset() // _ONE_US
+
+    return offsets, ambiguous, nonexistent
+
+
+def _localize_index(wall_us, index, fold, shift_forward):
+    """Resolve wall times through a zone's transition index"""
+    offsets = index.utcoffset_array(wall_us, fold)
+    ambiguous = index.is_ambiguous_array(wall_us)
+
+    nonexistent = ~index.exists_array(wall_us, fold)
+
+    if shift_forward and nonexistent.any():
+        offsets = np.where(nonexistent,
+                           _shift_forward_offsets(wall_us, index), offsets)
+
+    return offsets, ambiguous, nonexistent
+
+
+def _shift_forward_offsets(wall_us, index):
+    """
+    The offsets of imaginary wall times shifted forward as by
+    ``tz.resolve_imaginary``, i.e. by the change in offset across the gap.
+    """
+    # Times that only fail to exist with fold=1 aren't in any gap, and
+    # resolve_imaginary shifts them by the change in offset over a day
+    day = 86400000000
+    shift = (index.utcoffset_array(wall_us + day) -
+             index.utcoffset_array(wall_us - day))
+
+    arrays = index.arrays
+    if len(arrays["gap_starts"]):
+        ii = np.maximum(np.searchsorted(arrays["gap_starts"], wall_us,
+                                        side="right") - 1, 0)
+        starts, ends = arrays["gap_starts"][ii], arrays["gap_ends"][ii]
+        in_gap = (starts <= wall_us) & (wall_us < ends)
+        shift = np.where(in_gap, (index.utcoffset_array(ends) -
+                                  index.utcoffset_array(starts - 1)), shift)
+
+    # The shifted datetime has fold=0, as datetime arithmetic resets it
+    shifted = wall_us + shift
+    return wall_us - (shifted - index.utcoffset_array(shifted))
+
+
+def localize_array(dts, tzi, is_dst=False):
+    """
+    Bulk version of :func:`tz_answers.localize`.
+
+    ``dts`` is a ``datetime64`` array or a sequence of naive datetimes, all
+    interpreted as wall times in ``tzi``. ``is_dst`` may be:
+
+    - ``True`` or ``False``: resolve ambiguous times to the DST or standard
+      side, exactly as ``localize`` would.
+    - ``None`` or ``"raise"``: raise ``AmbiguousTimeError`` or
+      ``NonExistentTimeError`` for the first ambiguous or imaginary time.
+    - ``"NaT"``: set ambiguous and imaginary times to ``NaT``.
+    - ``"shift_forward"``: resolve ambiguous times to the later of the two
+      instants and shift imaginary times forward by the size of the gap (as
+      ``dateutil.tz.resolve_imaginary`` does).
+
+    Returns a :class:`LocalizedArray` of UTC datetimes, UTC offsets and masks
+    of the ambiguous and imaginary positions. ``NaT`` inputs stay ``NaT``.
+    """
+    if is_dst not in _IS_DST_POLICIES:
+        raise ValueError(f"Unknown is_dst policy: {is_dst!r}")
+
+    wall_us = _as_wall_us(dts)
+    nat = wall_us == _NAT
+
+    # Where there is a choice, "shift_forward" takes the later instant
+    fold = int(is_dst is False or is_dst == "shift_forward")
+    shift_forward = is_dst == "shift_forward"
+
+    index = get_transition_index(tzi)
+    if index is None:
+        offsets, ambiguous, nonexistent = _localize_scalar(wall_us, tzi, fold,
+                                                           shift_forward)
+    else:
+        offsets, ambiguous, nonexistent = _localize_index(wall_us, index,
+                                                          fold, shift_forward)
+
+    ambiguous &= ~nat
+    nonexistent &= ~nat
+
+    if is_dst is None or is_dst == "raise":
+        invalid = np.flatnonzero(ambiguous | nonexistent)
+        if len(invalid):
+            ii = invalid[0]
+            dt = wall_us[ii].astype("datetime64[us]").item()
+            if ambiguous[ii]:
+                raise AmbiguousTimeError(f"Ambiguous time {dt} in zone {tzi}")
+            raise NonExistentTimeError(
+                f"Time {dt} does not exist in zone {tzi}")
+
+    unresolved = nat
+    if is_dst == "NaT":
+        unresolved = unresolved | ambiguous | nonexistent
+
+    utc = np.where(unresolved, _NAT, wall_us - offsets)
+    offsets = np.where(unresolved, _NAT, offsets)
+
+    return LocalizedArray(utc=utc.view("datetime64[us]"),
+                          utcoffset=offsets.view("timedelta64[us]"),
+                          ambiguous=ambiguous,
+                          nonexistent=nonexistent)
+
+
+### Wall time / absolute time arithmetic
+def _as_us(values):
+    """
+    Convert a ``datetime64`` / ``timedelta64`` array or an array of integer
+    microseconds to ``int64`` microseconds. Also returns whether the input
+    was a NumPy datetime type, so results can be converted back.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[us]").view(np.int64), True
+    elif values.dtype.kind == "m":
+        return values.astype("timedelta64[us]").view(np.int64), True
+
+    return values.astype(np.int64), False
+
+
+def _as_offset_us(offset):
+    if isinstance(offset, timedelta):
+        return offset // _ONE_US
+
+    us, _ = _as_us(offset)
+    return us
+
+
+def _with_nat(us, *inputs):
+    """Propagate NaT from any of the inputs"""
+    nat = np.zeros(np.shape(us), dtype=bool)
+    for values in inputs:
+        nat |= values == _NAT
+
+    return np.where(nat, _NAT, us)
+
+
+def utc_to_wall(utc_us, tzi):
+    """
+    Convert UTC times (int64 us) to wall times and folds in ``tzi``. NaT
+    stays NaT.
+    """
+    index = get_transition_index(tzi)
+    if index is not None:
+        wall_us, folds = index.fromutc_array(utc_us)
+        return _with_nat(wall_us, utc_us), folds & (utc_us != _NAT)
+
+    wall_us = np.full_like(utc_us, _NAT)
+    folds = np.zeros(utc_us.shape, dtype=bool)
+    for ii, us in enumerate(utc_us.tolist()):
+        if us == _NAT:
+            continue
+
+        dt = (_EPOCH + timedelta(microseconds=us)).astimezone(tzi)
+        wall_us[ii] = (dt.replace(tzinfo=None) - _EPOCH.replace(tzinfo=None)
+                       ) // _ONE_US
+        folds[ii] = dt.fold
+
+    return wall_us, folds
+
+
+def wall_to_utc(wall_us, tzi, fold=0):
+    """
+    Convert wall times (int64 us) with the given fold(s) to UTC times. NaT
+    stays NaT.
+    """
+    index = get_transition_index(tzi)
+    if index is not None:
+        return _with_nat(wall_us - index.utcoffset_array(wall_us, fold),
+                         wall_us)
+
+    folds = np.broadcast_to(np.asarray(fold, dtype=int), wall_us.shape)
+    utc_us = np.full_like(wall_us, _NAT)
+    for ii, (us, fold) in enumerate(zip(wall_us.tolist(), folds.tolist())):
+        if us == _NAT:
+            continue
+
+        dt = datetime(1970, 1, 1) + timedelta(microseconds=us)
+        utc_us[ii] = us - (dt.replace(fold=fold, tzinfo=tzi).utcoffset() //
+                           _ONE_US)
+
+    return utc_us
+
+
+def wall_add_array(values, offset, tzi):
+    """
+    Bulk version of :func:`tz_answers.wall_add`.
+
+    ``values`` is a ``datetime64`` array (in UTC) or an array of integer UTC
+    microseconds since the epoch, representing times in the zone ``tzi``.
+    ``offset`` is a ``timedelta``, a ``timedelta64`` (array) or integer
+    microseconds. The result is the same kind of array as ``values``, with
+    each element the instant that ``wall_add`` would return.
+    """
+    utc_us, as_datetime64 = _as_us(values)
+    wall_us, _ = utc_to_wall(utc_us, tzi)
+
+    # Adding a timedelta to a datetime always gives fold=0
+    offset_us = _as_offset_us(offset)
+    wall_us = _with_nat(wall_us + offset_us, utc_us, offset_us)
+    out = wall_to_utc(wall_us, tzi, fold=0)
+    out = _with_nat(out, utc_us, offset_us)
+    return out.view("datetime64[us]") if as_datetime64 else out
+
+
+def wall_sub_array(values, other, tzi):
+    """
+    Bulk version of :func:`tz_answers.wall_sub`.
+
+    If ``other`` is a ``timedelta`` or ``timedelta64``, this is the same as
+    ``wall_add_array`` with the negated offset. Otherwise, ``other`` is a
+    second array of UTC times and the result is the difference between the
+    wall times in ``tzi`` (as ``timedelta64`` or integer microseconds).
+    """
+    if isinstance(other, timedelta) or np.asarray(other).dtype.kind == "m":
+        return wall_add_array(values, -_as_offset_us(other), tzi)
+
+    utc_us, as_datetime64 = _as_us(values)
+    other_us, _ = _as_us(other)
+    wall_us, _ = utc_to_wall(utc_us, tzi)
+    other_wall_us, _ = utc_to_wall(other_us, tzi)
+
+    out = _with_nat(wall_us - other_wall_us, utc_us, other_us)
+    return out.view("timedelta64[us]") if as_datetime64 else out
+
+
+def absolute_add_array(values, offset, tzi=None):
+    """
+    Bulk version of :func:`tz_answers.absolute_add`.
+
+    Absolute time arithmetic doesn't depend on the zone, so this is just
+    addition on the UTC times. ``tzi`` is accepted for symmetry with
+    ``wall_add_array``.
+    """
+    utc_us, as_datetime64 = _as_us(values)
+    out = _with_nat(utc_us + _as_offset_us(offset), utc_us)
+    return out.view("datetime64[us]") if as_datetime64 else out
+
+
+def absolute_sub_array(values, other, tzi=None):
+    """Bulk version of :func:`tz_answers.absolute_sub`"""
+    if isinstance(other, timedelta) or np.asarray(other).dtype.kind == "m":
+        return absolute_add_array(values, -_as_offset_us(other), tzi)
+
+    utc_us, as_datetime64 = _as_us(values)
+    other_us, _ = _as_us(other)
+
+    out = _with_nat(utc_us - other_us, utc_us, other_us)
+    return out.view("timedelta64[us]") if as_datetime64 else out
+
+
+### Compact arrays of WallDateTime / AbsoluteDateTime
+class DateTimeArray:
+    """
+    An array of datetimes in a single zone, with the explicit semantics of
+    either ``WallDateTime`` (``semantics="wall"``) or ``AbsoluteDateTime``
+    (``semantics="absolute"``).
+
+    Each element is stored as its wall time in ``int64`` microseconds since
+    the epoch plus a fold flag, so this takes 9 bytes per element rather than
+    a full ``datetime`` object. Scalar ``WallDateTime`` / ``AbsoluteDateTime``
+    objects are only created when individual elements are accessed.
+    """
+    _scalar_types = {"wall": WallDateTime, "absolute": AbsoluteDateTime}
+
+    def __init__(self, wall_us, fold=None, tzinfo=None, semantics="wall"):
+        if semantics not in self._scalar_types:
+            raise ValueError(f"Unknown semantics: {semantics!r}")
+
+        if semantics == "absolute" and tzinfo is None:
+            raise ValueError("Absolute semantics require a time zone")
+
+        self.wall_us = np.asarray(wall_us, dtype=np.int64)
+        if fold is None:
+            fold = np.zeros(self.wall_us.shape, dtype=bool)
+
+        self.fold = np.asarray(fold, dtype=bool)
+        self.tzinfo = tzinfo
+        self.semantics = semantics
+        self._utc_us = None
+
+    @classmethod
+    def from_datetimes(cls, dts, tzinfo=None, semantics=None):
+        """
+        Build an array from a sequence of datetimes in the same zone.
+
+        If not specified, ``semantics`` is taken from the type of the first
+        element (``"wall"`` unless it is an ``AbsoluteDateTime``), and
+        ``tzinfo`` is the zone of the first element.
+        """
+        dts = list(dts)
+        if dts:
+            if semantics is None and isinstance(dts[0], AbsoluteDateTime):
+                semantics = "absolute"
+
+            if tzinfo is None:
+                tzinfo = dts[0].tzinfo
+
+        if any(dt.tzinfo is not tzinfo for dt in dts):
+            raise ValueError("All datetimes must have the same tzinfo")
+
+        return cls([to_wall_us(dt) for dt in dts], [dt.fold for dt in dts],
+                   tzinfo=tzinfo, semantics=semantics or "wall")
+
+    @classmethod
+    def from_utc(cls, values, tzinfo, semantics="absolute"):
+        """Build an array from UTC times (``datetime64`` or integer us)"""
+        utc_us, _ = _as_us(values)
+        wall_us, fold = utc_to_wall(utc_us, tzinfo)
+        out = cls(wall_us, fold, tzinfo=tzinfo, semantics=semantics)
+        out._utc_us = utc_us
+
+        return out
+
+    def _new(self, wall_us, fold):
+        return self.__class__(wall_us, fold, tzinfo=self.tzinfo,
+                              semantics=self.semantics)
+
+    @property
+    def utc_us(self):
+        """The UTC times, in integer microseconds since the epoch"""
+        if self.tzinfo is None:
+            raise ValueError("Naive arrays have no UTC time")
+
+        if self._utc_us is None:
+            self._utc_us = wall_to_utc(self.wall_us, self.tzinfo,
+                                       fold=self.fold)
+
+        return self._utc_us
+
+    @property
+    def nbytes(self):
+        return self.wall_us.nbytes + self.fold.nbytes
+
+    def to_datetime64(self):
+        """The (naive) wall times as a ``datetime64[us]`` array"""
+        return self.wall_us.view("datetime64[us]")
+
+    ### Container methods
+    def __len__(self):
+        return len(self.wall_us)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            dt = datetime(1970, 1, 1) + timedelta(
+                microseconds=int(self.wall_us[key]))
+            dt = dt.replace(fold=int(self.fold[key]), tzinfo=self.tzinfo)
+            return self._scalar_types[self.semantics].from_datetime(dt)
+
+        return self._new(self.wall_us[key], self.fold[key])
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}({self.to_datetime64()!r}, "
+                f"tzinfo={self.tzinfo!r}, semantics={self.semantics!r})")
+
+    ### Arithmetic
+    def _other_us(self, other):
+        """Wall or UTC times of ``other`` to compare against this array"""
+        if isinstance(other, DateTimeArray):
+            if self.semantics == "wall":
+                return other.wall_us
+
+            return other.utc_us
+
+        if isinstance(other, datetime):
+            if self.semantics == "wall":
+                return to_wall_us(other)
+
+            return to_utc_us(other)
+
+        return None
+
+    def _key_us(self):
+        return self.wall_us if self.semantics == "wall" else self.utc_us
+
+    @staticmethod
+    def _is_offset(other):
+        return (isinstance(other, (timedelta, np.timedelta64)) or
+                (isinstance(other, np.ndarray) and other.dtype.kind == "m"))
+
+    def _add_us(self, offset_us):
+        if self.semantics == "wall":
+            # Adding a timedelta to a datetime always gives fold=0
+            wall_us = self.wall_us + offset_us
+            return self._new(wall_us, np.zeros(wall_us.shape, dtype=bool))
+
+        return self.from_utc(self.utc_us + offset_us, self.tzinfo,
+                             semantics=self.semantics)
+
+    def __add__(self, other):
+        if not self._is_offset(other):
+            return NotImplemented
+
+        return self._add_us(_as_offset_us(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if self._is_offset(other):
+            return self._add_us(-_as_offset_us(other))
+
+        other_us = self._other_us(other)
+        if other_us is None:
+            return NotImplemented
+
+        return (self._key_us() - other_us).view("timedelta64[us]")
+
+    ### Comparisons
+    def _compare(self, other, op):
+        other_us = self._other_us(other)
+        if other_us is None:
+            return NotImplemented
+
+        return op(self._key_us(), other_us)
+
+    def __eq__(self, other):
+        return self._compare(other, np.equal)
+
+    def __ne__(self, other):
+        return self._compare(other, np.not_equal)
+
+    def __lt__(self, other):
+        return self._compare(other, np.less)
+
+    def __le__(self, other):
+        return self._compare(other, np.less_equal)
+
+    def __gt__(self, other):
+        return self._compare(other, np.greater)
+
+    def __ge__(self, other):
+        return self._compare(other, np.greater_equal)
+
+    def argsort(self):
+        return np.argsort(self._key_us(), kind="stable")
+
+
+### Sorting and searching by absolute time
+def absolute_keys(dts):
+    """
+    An ``int64`` array of the UTC microseconds since the epoch of each
+    datetime, using the cached key for ``AbsoluteDateTime`` instances.
+    """
+    return np.array([dt.utc_key if isinstance(dt, AbsoluteDateTime)
+                     else to_utc_us(dt) for dt in dts], dtype=np.int64)
+
+
+def sort_absolute(dts):
+    """
+    Sort datetimes by the instant they represent.
+
+    Equivalent to ``sorted(dts)`` for ``AbsoluteDateTime`` (including
+    stability), but the keys are computed once and sorted as integers.
+    """
+    dts = list(dts)
+    order = np.argsort(absolute_keys(dts), kind="stable")
+    return [dts[ii] for ii in order.tolist()]
+
+
+def unique_absolute(dts):
+    """
+    Sort datetimes by instant, keeping only the first of each set of
+    datetimes that represent the same instant.
+    """
+    dts = list(dts)
+    keys = absolute_keys(dts)
+    _, first = np.unique(keys, return_index=True)
+    return [dts[ii] for ii in first.tolist()]
+
+
+def searchsorted_absolute(sorted_keys, dts, side="left"):
+    """
+    Find the insertion points of ``dts`` in a sorted key array (from
+    ``absolute_keys``), like ``bisect.bisect_left`` / ``bisect_right``.
+    """
+    if isinstance(dts, datetime):
+        return int(np.searchsorted(sorted_keys, absolute_keys([dts])[0],
+                                   side=side))
+
+    return np.searchsorted(sorted_keys, absolute_keys(dts), side=side)
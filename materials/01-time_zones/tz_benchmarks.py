@@ -0,0 +1,303 @@
+"""
+Benchmarks for ``tz_answers`` and the bulk versions in ``tz_arrays``.
+
+These only use the standard library's ``timeit``, so they can be run offline
+from this directory:
+
+    python tz_benchmarks.py                     # Run everything
+    python tz_benchmarks.py -k localize         # Only names containing this
+    python tz_benchmarks.py -o new.json         # Save the results
+    python tz_benchmarks.py --compare old.json  # Compare against saved results
+
+The data sets are concentrated around DST transitions, where the interesting
+(and slow) code paths are.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import timeit
+
+from datetime import datetime, timedelta, timezone
+
+import dateutil
+import numpy as np
+
+from dateutil import tz
+
+import tz_answers
+import tz_arrays
+
+ZONES = ['America/New_York', 'Europe/London', 'Australia/Lord_Howe',
+         'America/Santiago']
+YEARS = range(2000, 2030)
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a function that sets up a benchmark and returns it"""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+### Data sets
+def get_naive_dataset(zone_name, n_random=2000, seed=0):
+    """
+    Naive wall times every 10 minutes for the 3 hours around each transition
+    of the zone, plus some random times throughout the period.
+    """
+    zone = tz.gettz(zone_name)
+    start, end = datetime(YEARS[0], 1, 1), datetime(YEARS[-1] + 1, 1, 1)
+
+    dts = []
+    for trans in zone._trans_list:
+        dt = datetime(1970, 1, 1) + timedelta(seconds=trans)
+        if start <= dt < end:
+            dts.extend(dt + timedelta(minutes=m) for m in range(-90, 90, 10))
+
+    rng = random.Random(seed)
+    span = int((end - start).total_seconds())
+    dts.extend(start + timedelta(seconds=rng.randrange(span))
+               for _ in range(n_random))
+
+    return dts
+
+
+def get_aware_dataset(zone_name, **kwargs):
+    """The naive data set, attached to the zone with random folds"""
+    zone = tz.gettz(zone_name)
+    rng = random.Random(1)
+    return [dt.replace(tzinfo=zone, fold=rng.randint(0, 1))
+            for dt in get_naive_dataset(zone_name, **kwargs)]
+
+
+def _all_naive():
+    return [(tz.gettz(name), get_naive_dataset(name)) for name in ZONES]
+
+
+def _all_aware():
+    return [dt for name in ZONES for dt in get_aware_dataset(name)]
+
+
+### Localization
+def _make_localize(is_dst):
+    def setup():
+        data = _all_naive()
+
+        def run():
+            for zone, dts in data:
+                for dt in dts:
+                    try:
+                        tz_answers.localize(dt, zone, is_dst=is_dst)
+                    except (tz_answers.AmbiguousTimeError,
+                            tz_answers.NonExistentTimeError):
+                        pass
+
+        return run
+
+    return setup
+
+
+def _make_localize_array(is_dst):
+    def setup():
+        data = [(zone, np.array(dts, dtype='datetime64[us]'))
+                for zone, dts in _all_naive()]
+
+        def run():
+            for zone, dts in data:
+                tz_arrays.localize_array(dts, zone, is_dst=is_dst)
+
+        return run
+
+    return setup
+
+
+for _is_dst in (True, False, None):
+    benchmark(f"localize[is_dst={_is_dst}]")(_make_localize(_is_dst))
+
+for _is_dst in (True, False, "NaT", "shift_forward"):
+    benchmark(f"localize_array[is_dst={_is_dst}]")(
+        _make_localize_array(_is_dst))
+
+
+### Arithmetic
+_OFFSET = timedelta(hours=1)
+
+
+def _make_scalar_arithmetic(func, use_datetimes):
+    def setup():
+        dts = _all_aware()
+        others = dts[1:] + dts[:1] if use_datetimes else [_OFFSET] * len(dts)
+
+        def run():
+            for dt, other in zip(dts, others):
+                func(dt, other)
+
+        return run
+
+    return setup
+
+
+def _make_array_arithmetic(func, use_datetimes):
+    def setup():
+        data = []
+        for name in ZONES:
+            dts = get_aware_dataset(name)
+            utc = np.array([dt.astimezone(timezone.utc).replace(tzinfo=None)
+                            for dt in dts], dtype='datetime64[us]')
+            other = np.roll(utc, 1) if use_datetimes else _OFFSET
+            data.append((tz.gettz(name), utc, other))
+
+        def run():
+            for zone, utc, other in data:
+                func(utc, other, zone)
+
+        return run
+
+    return setup
+
+
+for _name, _use_datetimes in [("wall_add", False), ("wall_sub", True),
+                              ("absolute_add", False),
+                              ("absolute_sub", True)]:
+    benchmark(_name)(_make_scalar_arithmetic(getattr(tz_answers, _name),
+                                             _use_datetimes))
+    benchmark(f"{_name}_array")(
+        _make_array_arithmetic(getattr(tz_arrays, f"{_name}_array"),
+                               _use_datetimes))
+
+
+### Sorting and comparing WallDateTime / AbsoluteDateTime
+def _make_sort(cls, sort_func=sorted):
+    def setup():
+        dts = _all_aware()
+        random.Random(2).shuffle(dts)
+
+        def run():
+            # Build new objects each time, so that cached keys are included
+            sort_func([cls.from_datetime(dt) for dt in dts])
+
+        return run
+
+    return setup
+
+
+def _make_compare(cls):
+    def setup():
+        dts = [cls.from_datetime(dt) for dt in _all_aware()]
+        pairs = list(zip(dts, dts[1:] + dts[:1]))
+
+        def run():
+            for dt1, dt2 in pairs:
+                dt1 == dt2
+                dt1 < dt2
+
+        return run
+
+    return setup
+
+
+@benchmark("construct[AbsoluteDateTime]")
+def _construct():
+    dts = _all_aware()
+
+    def run():
+        for dt in dts:
+            tz_answers.AbsoluteDateTime.from_datetime(dt)
+
+    return run
+
+
+for _cls in (tz_answers.WallDateTime, tz_answers.AbsoluteDateTime):
+    benchmark(f"sort[{_cls.__name__}]")(_make_sort(_cls))
+    benchmark(f"compare[{_cls.__name__}]")(_make_compare(_cls))
+
+benchmark("sort_absolute[AbsoluteDateTime]")(
+    _make_sort(tz_answers.AbsoluteDateTime, tz_arrays.sort_absolute))
+
+
+### Runner
+def run_benchmark(name, repeat=5):
+    """Time one benchmark, returning the time per call for each repeat"""
+    func = BENCHMARKS[name]()
+    func()      # Warm up caches (e.g. the transition index)
+
+    timer = timeit.Timer(func)
+    loops, _ = timer.autorange()
+
+    values = [t / loops for t in timer.repeat(repeat=repeat, number=loops)]
+    return {"loops": loops, "values": values}
+
+
+def get_metadata():
+    return {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "dateutil": dateutil.__version__,
+        "numpy": np.__version__,
+        "date": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return f"{seconds * scale:.2f} {unit}"
+
+    return f"{seconds * 1e9:.0f} ns"
+
+
+def print_results(results, baseline=None):
+    for name, result in results["benchmarks"].items():
+        mean = statistics.mean(result["values"])
+        line = f"{name:<40} {_format_time(mean):>12}"
+        if len(result["values"]) > 1:
+            line += f" +- {_format_time(statistics.stdev(result['values']))}"
+
+        if baseline and name in baseline["benchmarks"]:
+            old = statistics.mean(baseline["benchmarks"][name]["values"])
+            line += f"   ({old / mean:.2f}x vs {_format_time(old)})"
+
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", dest="filter", default="",
+                        help="Only run benchmarks whose name contains this")
+    parser.add_argument("-o", "--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--list", action="store_true",
+                        help="List the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {"metadata": get_metadata(), "benchmarks": {}}
+    for name in names:
+        results["benchmarks"][name] = run_benchmark(name, repeat=args.repeat)
+        print_results({"benchmarks": {name: results["benchmarks"][name]}},
+                      baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+"""
+Supporting code for ``tz_answers`` and ``tz_arrays``.
+
+The main piece is :class:`TransitionIndex`, which precomputes the transitions
+of a time zone so that questions like "is this wall time ambiguous?" or
+"what is the UTC offset of this wall time?" can be answered with a binary
+search rather than by repeatedly probing the ``tzinfo``.
+"""
+import threading
+
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from dateutil import tz
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+# Stand-ins for -infinity and +infinity, in microseconds
+_MIN_US = -(2 ** 62)
+_MAX_US = 2 ** 62
+
+
+class LRUCache:
+    """A bounded, thread-safe mapping that drops the least recently used key"""
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            self._evict()
+
+    def resize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class TransitionIndex:
+    """
+    The transitions of a time zone, resolved the same way ``dateutil`` does.
+
+    All times are integers in microseconds since 1970-01-01, either as wall
+    times or as UTC times:
+
+    - ``wall`` and ``utc`` are the sorted transition times.
+    - ``offsets[idx + 1]`` is the UTC offset after transition ``idx``, and
+      ``offsets[0]`` is the offset before the first transition.
+    - ``folds`` and ``gaps`` are sorted, non-overlapping ``(start, end)``
+      intervals of ambiguous and imaginary (with ``fold=0``) wall times.
+    """
+    def __init__(self, wall, utc, offsets):
+        self.wall = tuple(wall)
+        self.utc = tuple(utc)
+        self.offsets = tuple(offsets)
+
+        self.folds = tuple(self._find_folds())
+        self._fold_starts = [start for start, _ in self.folds]
+
+        self.gaps = tuple(self._find_gaps())
+        self._gap_starts = [start for start, _ in self.gaps]
+        self._arrays = None
+
+    @classmethod
+    def from_tzinfo(cls, tzi):
+        """
+        Build the index for a zone, or return ``None`` if the zone's
+        transitions can't be determined without probing it.
+        """
+        if isinstance(tzi, (timezone, tz.tzutc, tz.tzoffset)):
+            offset = datetime(1970, 1, 1, tzinfo=tzi).utcoffset()
+            return cls((), (), (offset // _ONE_US,))
+
+        if isinstance(tzi, tz.tzfile):
+            if not tzi._ttinfo_std:
+                return cls((), (), (0,))
+
+            # This mirrors tzfile._find_last_transition and tzfile._get_ttinfo
+            wall = [t * 1000000 for t in tzi._trans_list]
+            utc = [t * 1000000 for t in tzi._trans_list_utc]
+            offsets = [tzi._get_ttinfo(idx).offset * 1000000
+                       for idx in range(-1, len(wall))]
+
+            return cls(wall, utc, offsets)
+
+        return None
+
+    def _find_folds(self):
+        # A wall time after transition idx is ambiguous if it's less than
+        # the change in offset past the transition (see tzfile.is_ambiguous)
+        wall = self.wall + (_MAX_US,)
+        for idx in range(1, len(self.wall)):
+            od = self.offsets[idx] - self.offsets[idx + 1]
+            end = min(wall[idx] + od, wall[idx + 1])
+            if end > wall[idx]:
+                yield (wall[idx], end)
+
+    def _find_gaps(self):
+        # A wall time exists if it survives a round trip through UTC. Split
+        # the wall time line into pieces with a constant offset and find the
+        # parts of each piece that map back to a different offset.
+        breaks = sorted(set(self.wall).union(end for _, end in self.folds))
+        breaks = [_MIN_US] + breaks + [_MAX_US]
+        utc = (_MIN_US,) + self.utc + (_MAX_US,)
+
+        gaps = []
+        for start, end in zip(breaks[:-1], breaks[1:]):
+            if start >= end:
+                continue
+
+            offset = self.utcoffset(start, fold=0)
+            first = max(bisect_right(utc, start - offset) - 1, 0)
+            last = min(bisect_right(utc, end - 1 - offset) - 1, len(self.utc))
+            for jj in range(first, last + 1):
+                if self.offsets[jj] == offset:
+                    continue
+
+                gap = (max(start, utc[jj] + offset),
+                       min(end, utc[jj + 1] + offset))
+                if gaps and gaps[-1][1] == gap[0]:
+                    gaps[-1] = (gaps[-1][0], gap[1])
+                else:
+                    gaps.append(gap)
+
+        return gaps
+
+    @staticmethod
+    def _in_intervals(intervals, starts, us):
+        ii = bisect_right(starts, us) - 1
+        return ii >= 0 and us < intervals[ii][1]
+
+    def is_ambiguous(self, wall_us):
+        return self._in_intervals(self.folds, self._fold_starts, wall_us)
+
+    def exists(self, wall_us, fold=0):
+        # As in tz.datetime_exists, a wall time (with its fold) exists if it
+        # survives a round trip through UTC. Where two transitions are close
+        # together, a time can exist with one fold and not the other.
+        return self.fromutc(wall_us - self.utcoffset(wall_us, fold))[0] == \
+            wall_us
+
+    def utcoffset(self, wall_us, fold=0):
+        """The UTC offset of a wall time with the given fold"""
+        idx = bisect_right(self.wall, wall_us) - 1
+        if not fold and idx > 0 and self.is_ambiguous(wall_us):
+            idx -= 1
+
+        return self.offsets[idx + 1]
+
+    def fromutc(self, utc_us):
+        """Convert a UTC time to a ``(wall, fold)`` tuple"""
+        idx = bisect_right(self.utc, utc_us) - 1
+        wall_us = utc_us + self.offsets[idx + 1]
+
+        # See tzfile.fromutc and tzfile.is_ambiguous
+        fold = int(idx > 0 and wall_us < (self.wall[idx] + self.offsets[idx] -
+                                          self.offsets[idx + 1]))
+
+        return wall_us, fold
+
+    ### Vectorized versions
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            def as_array(values):
+                return np.array(values, dtype=np.int64)
+
+            self._arrays = {
+                "wall": as_array(self.wall),
+                "utc": as_array(self.utc),
+                "offsets": as_array(self.offsets),
+                "fold_starts": as_array(self._fold_starts),
+                "fold_ends": as_array([end for _, end in self.folds]),
+                "gap_starts": as_array(self._gap_starts),
+                "gap_ends": as_array([end for _, end in self.gaps]),
+            }
+
+        return self._arrays
+
+    def _in_intervals_array(self, name, us):
+        arrays = self.arrays
+        starts, ends = arrays[name + "_starts"], arrays[name + "_ends"]
+        if not len(starts):
+            return np.zeros(np.shape(us), dtype=bool)
+
+        ii = np.searchsorted(starts, us, side="right") - 1
+        return (ii >= 0) & (us < ends[np.maximum(ii, 0)])
+
+    def is_ambiguous_array(self, wall_us):
+        return self._in_intervals_array("fold", wall_us)
+
+    def exists_array(self, wall_us, fold=0):
+        """Vectorized :meth:`exists`; ``fold`` may be an array"""
+        offsets = self.utcoffset_array(wall_us, fold)
+        return self.fromutc_array(wall_us - offsets)[0] == wall_us
+
+    def utcoffset_array(self, wall_us, fold=0):
+        """Vectorized :meth:`utcoffset`; ``fold`` may be an array"""
+        arrays = self.arrays
+        idx = np.searchsorted(arrays["wall"], wall_us, side="right") - 1
+        earlier = self.is_ambiguous_array(wall_us) & (np.asarray(fold) == 0)
+
+        return arrays["offsets"][idx - earlier + 1]
+
+    def fromutc_array(self, utc_us):
+        """Vectorized :meth:`fromutc`, returning wall and fold arrays"""
+        arrays = self.arrays
+        idx = np.searchsorted(arrays["utc"], utc_us, side="right") - 1
+        wall_us = utc_us + arrays["offsets"][idx + 1]
+        if not len(self.wall):
+            return wall_us, np.zeros(np.shape(wall_us), dtype=bool)
+
+        prev = np.maximum(idx, 0)
+        od = arrays["offsets"][prev] - arrays["offsets"][prev + 1]
+        fold = (idx > 0) & (wall_us < arrays["wall"][prev] + od)
+
+        return wall_us, fold
+
+
+_INDEX_CACHE = LRUCache(maxsize=512)
+
+
+def get_transition_index(tzi):
+    """
+    Get the (cached) :class:`TransitionIndex` for ``tzi``, or ``None`` if the
+    zone is not supported.
+    """
+    if tzi is None:
+        return None
+
+    # Most tzinfo objects aren't hashable, so cache by identity; the cache
+    # holds a reference to the zone so that its id can't be reused.
+    key = id(tzi)
+    cached = _INDEX_CACHE.get(key)
+    if cached is not None and cached[0] is tzi:
+        return cached[1]
+
+    index = TransitionIndex.from_tzinfo(tzi)
+    _INDEX_CACHE.put(key, (tzi, index))
+
+    return index
+
+
+### Zone resolution
+_ZONE_CACHE = LRUCache(maxsize=512)
+
+
+def get_zone(name):
+    """
+    Same as ``tz.gettz``, but keeps up to 512 zones alive.
+
+    ``tz.gettz`` only holds strong references to the 8 most recently used
+    zones, so cycling through more zones than that rebuilds them over and
+    over again.
+    """
+    zone = _ZONE_CACHE.get(name)
+    if zone is None:
+        zone = tz.gettz(name)
+        if zone is not None:
+            _ZONE_CACHE.put(name, zone)
+
+    return zone
+
+
+def set_zone_cache_size(maxsize):
+    _ZONE_CACHE.resize(maxsize)
+
+
+def preload_zones(names):
+    """
+    Warm up the zone cache (and the transition index for each zone) so that
+    later lookups don't pay for it. Returns the names that couldn't be found.
+    """
+    missing = []
+    for name in names:
+        zone = get_zone(name)
+        if zone is None:
+            missing.append(name)
+        else:
+            get_transition_index(zone)
+
+    return missing
+
+
+def in_zones(dts, tz_names):
+    """
+    Convert an aware datetime, or a sequence of aware datetimes, to each of
+    the zones in ``tz_names``.
+
+    Returns a dictionary mapping each zone name to the converted datetime (or
+    list of datetimes).
+    """
+    zones = {}
+    for name in tz_names:
+        zones[name] = get_zone(name)
+        if zones[name] is None:
+            raise ValueError(f"Unknown time zone: {name}")
+
+    if isinstance(dts, datetime):
+        # Convert to UTC once, then look up the offset in each zone
+        utc_us = to_utc_us(dts)
+        out = {}
+        for name, zone in zones.items():
+            index = get_transition_index(zone)
+            if index is None:
+                out[name] = dts.astimezone(zone)
+            else:
+                wall_us, fold = index.fromutc(utc_us)
+                out[name] = _from_us(wall_us).replace(fold=fold, tzinfo=zone)
+
+        return out
+
+    # Convert to UTC once, then convert to each zone in bulk
+    dts = list(dts)
+    utc_us = np.array([to_utc_us(dt) for dt in dts], dtype=np.int64)
+
+    out = {}
+    for name, zone in zones.items():
+        index = get_transition_index(zone)
+        if index is None:
+            out[name] = [dt.astimezone(zone) for dt in dts]
+            continue
+
+        wall_us, folds = index.fromutc_array(utc_us)
+        out[name] = [_from_us(us).replace(fold=fold, tzinfo=zone)
+                     for us, fold in zip(wall_us.tolist(), folds.tolist())]
+
+    return out
+
+
+### Drop-in replacements for datetime and dateutil functions
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+
+def to_wall_us(dt):
+    """Microseconds since the epoch of the wall time of ``dt``"""
+    # Computed by hand so that it works on datetime subclasses that
+    # redefine subtraction (like tz_answers.AbsoluteDateTime)
+    seconds = ((dt.toordinal() - _EPOCH_ORDINAL) * 86400 +
+               dt.hour * 3600 + dt.minute * 60 + dt.second)
+    return seconds * 1000000 + dt.microsecond
+
+
+def _from_us(us):
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def datetime_ambiguous(dt, tzi=None):
+    """Same as ``dateutil.tz.datetime_ambiguous``, using the index"""
+    if tzi is None:
+        tzi = dt.tzinfo
+
+    index = get_transition_index(tzi)
+    if index is None:
+        return tz.datetime_ambiguous(dt, tzi)
+
+    return index.is_ambiguous(to_wall_us(dt))
+
+
+def datetime_exists(dt, tzi=None):
+    """Same as ``dateutil.tz.datetime_exists``, using the index"""
+    if tzi is None:
+        tzi = dt.tzinfo
+
+    index = get_transition_index(tzi)
+    if index is None:
+        return tz.datetime_exists(dt, tzi)
+
+    return index.exists(to_wall_us(dt), dt.fold)
+
+
+def to_utc_us(dt):
+    """Microseconds since the epoch of ``dt.astimezone(timezone.utc)``"""
+    index = get_transition_index(dt.tzinfo)
+    if index is None:
+        return to_wall_us(dt.astimezone(timezone.utc))
+
+    wall_us = to_wall_us(dt)
+    return wall_us - index.utcoffset(wall_us, dt.fold)
+
+
+def to_utc(dt):
+    """Same as ``dt.astimezone(timezone.utc)``, using the index"""
+    return _from_us(to_utc_us(dt)).replace(tzinfo=timezone.utc)
+
+
+def from_utc(dt, tzi):
+    """Same as ``dt.astimezone(tzi)`` for an aware ``dt``, using the index"""
+    index = get_transition_index(tzi)
+    if index is None:
+        return dt.astimezone(tzi)
+
+    utc_us = to_wall_us(dt) - dt.utcoffset() // _ONE_US
+    wall_us, fold = index.fromutc(utc_us)
+    return _from_us(wall_us).replace(fold=fold, tzinfo=tzi)
@@ -1,8 +1,10 @@
 from contextlib import contextmanager
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, tzinfo
 
 from dateutil import tz
 
+import numpy as np
+
 import tz_answers
 from tz_answers import AmbiguousTimeError, NonExistentTimeError
 
@@ -33,6 +35,23 @@ def test_utc(utc):
     print("Passed!")
 
 
+### Current time in multiple time zones (batch version)
+def test_in_zones(in_zones):
+    zones = ['America/New_York', 'Asia/Kolkata', 'Australia/Lord_Howe', 'UTC']
+    dts = [datetime(2020, 11, 1, 5, 30, tzinfo=timezone.utc),
+           datetime(2020, 11, 1, 6, 30, tzinfo=timezone.utc)]
+
+    act = in_zones(dts, zones)
+    for tzstr in zones:
+        for dt, dt_act in zip(dts, act[tzstr]):
+            assert_dt_equal(dt_act, dt.astimezone(tz.gettz(tzstr)))
+            assert dt_act.fold == dt.astimezone(tz.gettz(tzstr)).fold
+
+        assert_dt_equal(in_zones(dts[0], zones)[tzstr], act[tzstr][0])
+
+    print("Passed!")
+
+
 ### Exercise: Build a pytz-style exception-based localizer with dateutil
 @contextmanager
 def assert_raises(err_type):
@@ -77,6 +96,27 @@ def test_localize(localize):
     print("Passed!")
 
 
+def test_datetime_exists(datetime_exists):
+    # Where two transitions are close together, a wall time can exist with
+    # one fold and not the other
+    cases = [
+        datetime(1941, 8, 10, 1, 4, tzinfo=tz.gettz('Europe/London')),
+        datetime(1983, 10, 30, 2, tzinfo=tz.gettz('America/Juneau')),
+        datetime(2004, 4, 4, 2, 30, tzinfo=NYC),
+        datetime(2004, 10, 31, 1, 30, tzinfo=NYC),
+    ]
+
+    for dt in cases:
+        for fold in (0, 1):
+            dt = dt.replace(fold=fold)
+            assert datetime_exists(dt) == tz.datetime_exists(dt), \
+                f"datetime_exists({dt!r})"
+
+    assert not datetime_exists(cases[0].replace(fold=1))
+
+    print("Passed!")
+
+
 ### Exercise: Implement explicit wall-time and absolute-time arithmetic
 NYC = tz.gettz('America/New_York')
 SUB_PAIRS = [
@@ -120,3 +160,169 @@ def test_absolute_add(absolute_add):
             f"absolute_add({dt}, {off})"
 
     print("Passed!")
+
+
+### Bulk localization
+def test_localize_array(localize_array):
+    naive = [
+        datetime(2004, 10, 31, 1, 30),      # Ambiguous
+        datetime(2004, 4, 4, 2, 30),        # Imaginary
+        datetime(2004, 6, 1, 12),
+    ]
+
+    for is_dst in (True, False):
+        result = localize_array(naive, NYC, is_dst=is_dst)
+        for dt, dt_utc in zip(naive, result.utc.tolist()):
+            exp = tz_answers.localize(dt, NYC, is_dst=is_dst)
+            assert dt_utc == exp.astimezone(tz.UTC).replace(tzinfo=None), \
+                f"localize_array({dt}, is_dst={is_dst})"
+
+    assert list(result.ambiguous) == [True, False, False]
+    assert list(result.nonexistent) == [False, True, False]
+
+    with assert_raises(AmbiguousTimeError):
+        localize_array(naive, NYC, is_dst=None)
+
+    with assert_raises(NonExistentTimeError):
+        localize_array(naive[1:], NYC, is_dst="raise")
+
+    result = localize_array(naive, NYC, is_dst="NaT")
+    assert [dt is None for dt in result.utc.tolist()] == [True, True, False]
+
+    print("Passed!")
+
+
+class _ProbedZone(tzinfo):
+    """A zone without a transition table, so it is resolved by probing"""
+    def __init__(self, zone):
+        self._zone = zone
+
+    def utcoffset(self, dt):
+        return self._zone.utcoffset(dt.replace(tzinfo=self._zone))
+
+    def dst(self, dt):
+        return self._zone.dst(dt.replace(tzinfo=self._zone))
+
+    def tzname(self, dt):
+        return self._zone.tzname(dt.replace(tzinfo=self._zone))
+
+    def fromutc(self, dt):
+        dt = self._zone.fromutc(dt.replace(tzinfo=self._zone))
+        return dt.replace(tzinfo=self)
+
+    def is_ambiguous(self, dt):
+        return self._zone.is_ambiguous(dt.replace(tzinfo=self._zone))
+
+
+def test_localize_array_transitions(localize_array):
+    # Zones with transitions close together, where existence depends on
+    # the fold and the shift depends on the gap
+    cases = [
+        ("America/Juneau", datetime(1983, 10, 30, 2)),
+        ("Asia/Tomsk", datetime(2002, 5, 1, 1)),
+        ("Europe/Tallinn", datetime(1941, 9, 15, 0)),
+        ("Europe/Dublin", datetime(1916, 10, 1, 2)),
+        ("America/New_York", datetime(2004, 4, 4, 2, 30)),
+    ]
+
+    for name, dt in cases:
+        zone = tz.gettz(name)
+        naive = [dt + timedelta(minutes=m) for m in range(-90, 91, 15)]
+        for is_dst in (True, False, "NaT", "shift_forward"):
+            exp = localize_array(naive, _ProbedZone(zone), is_dst=is_dst)
+            act = localize_array(naive, zone, is_dst=is_dst)
+            for field in exp._fields:
+                assert (getattr(act, field).tolist() ==
+                        getattr(exp, field).tolist()), \
+                    f"localize_array({name}, is_dst={is_dst!r}).{field}"
+
+        # The probed path agrees with dateutil itself
+        exp_utc = tz.resolve_imaginary(dt.replace(tzinfo=zone, fold=1))
+        act = localize_array([dt], zone, is_dst="shift_forward")
+        assert act.utc.tolist() == [
+            exp_utc.astimezone(tz.UTC).replace(tzinfo=None)], name
+
+    print("Passed!")
+
+
+### Sorting absolute times
+def test_sort_absolute(sort_absolute):
+    LON = tz.gettz('Europe/London')
+    dts = [
+        tz_answers.AbsoluteDateTime(2020, 11, 1, 1, 30, fold=1, tzinfo=NYC),
+        tz_answers.AbsoluteDateTime(2020, 11, 1, 1, 30, fold=0, tzinfo=NYC),
+        tz_answers.AbsoluteDateTime(2020, 11, 1, 5, 30, tzinfo=LON),
+        tz_answers.AbsoluteDateTime(2020, 11, 1, 6, 0, tzinfo=timezone.utc),
+    ]
+
+    exp = sorted(dts, key=lambda dt: dt.as_datetime().astimezone(tz.UTC))
+    assert sort_absolute(dts) == exp
+    assert sort_absolute(dts)[-1] is dts[0]
+
+    # The 5:30 in London is the same instant as 01:30 EDT
+    assert len(set(dts)) == 3
+
+    # ... and equal to plain datetimes at the same instant, which hash the same
+    plain = [dt.astimezone(timezone.utc) for dt in dts[1:]]
+    assert plain == dts[1:] and len(set(dts[1:] + plain)) == 2
+
+    print("Passed!")
+
+
+### Bulk wall-time and absolute-time arithmetic
+def test_add_arrays(wall_add_array, absolute_add_array):
+    dts = [
+        datetime(2018, 3, 10, 13, tzinfo=NYC),
+        datetime(2018, 11, 4, 1, 30, fold=0, tzinfo=NYC),
+        datetime(2018, 11, 4, 1, 30, fold=1, tzinfo=NYC),
+    ]
+    utc = [dt.astimezone(tz.UTC).replace(tzinfo=None) for dt in dts]
+    utc = np.array(utc, dtype='datetime64[us]')
+
+    for off in (timedelta(hours=1), timedelta(days=1), timedelta(hours=-1)):
+        wall = wall_add_array(utc, off, NYC).tolist()
+        absolute = absolute_add_array(utc, off, NYC).tolist()
+        for dt, dt_wall, dt_abs in zip(dts, wall, absolute):
+            exp_wall = tz_answers.wall_add(dt, off).astimezone(tz.UTC)
+            exp_abs = tz_answers.absolute_add(dt, off).astimezone(tz.UTC)
+
+            assert dt_wall == exp_wall.replace(tzinfo=None), \
+                f"wall_add_array({dt}, {off})"
+            assert dt_abs == exp_abs.replace(tzinfo=None), \
+                f"absolute_add_array({dt}, {off})"
+
+    # NaT stays NaT, whether or not the zone has a transition table
+    with_nat = np.append(utc, np.datetime64('NaT'))
+    for zone in (NYC, tz.tzlocal()):
+        wall = wall_add_array(with_nat, timedelta(hours=1), zone)
+        assert list(np.isnat(wall)) == [False] * len(utc) + [True], \
+            f"wall_add_array(NaT, {zone})"
+
+        wall = wall_add_array(with_nat, np.timedelta64('NaT'), zone)
+        assert np.isnat(wall).all(), f"wall_add_array(.., NaT, {zone})"
+
+    print("Passed!")
+
+
+### Compact arrays of WallDateTime / AbsoluteDateTime
+def test_datetime_array(DateTimeArray):
+    for cls in (tz_answers.WallDateTime, tz_answers.AbsoluteDateTime):
+        dts = [
+            cls(2018, 11, 4, 0, 30, tzinfo=NYC),
+            cls(2018, 11, 4, 1, 30, fold=0, tzinfo=NYC),
+            cls(2018, 11, 4, 1, 30, fold=1, tzinfo=NYC),
+        ]
+
+        arr = DateTimeArray.from_datetimes(dts)
+        for off in (timedelta(hours=1), timedelta(hours=-1)):
+            for dt, dt_act in zip(dts, arr + off):
+                dt_exp = dt + off
+                assert isinstance(dt_act, cls)
+                assert dt_act.replace(tzinfo=None) == \
+                    dt_exp.replace(tzinfo=None), f"{dt} + {off}"
+                assert dt_act.fold == dt_exp.fold, f"{dt} + {off}"
+
+        assert list(arr - dts[0]) == [dt - dts[0] for dt in dts]
+        assert list(arr < dts[2]) == [dt < dts[2] for dt in dts]
+
+    print("Passed!")
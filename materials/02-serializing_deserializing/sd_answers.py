@@ -1,34 +1,81 @@
 ### Exercise: Write a function to store a message with metadata in JSON
+import functools
 import json
 import logging
+import math
+import os
 
+from collections import OrderedDict
 from dateutil import tz
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
-def encode_message(user_to: str, user_from: str, message: str) -> str:
-    """Encode a message to be sent in JSON"""
+def encode_message(user_to: str, user_from: str, message: str,
+                   epoch_unit: str = "s") -> str:
+    """
+    Encode a message to be sent in JSON
+
+    By default the time it was sent is stored as a float ``sent_epoch``;
+    with ``epoch_unit`` of ``"us"`` or ``"ns"``, it is stored exactly, as
+    an integer ``sent_epoch_us`` or ``sent_epoch_ns``.
+    """
     message_time = datetime.now(timezone.utc)
+    epoch_field, epoch = get_epoch_field(message_time, epoch_unit)
 
     to_encode = {
         "user_to": user_to,
         "user_from": user_from,
-        "sent_epoch": message_time.timestamp(),
+        epoch_field: epoch,
         "message": message
     }
 
     return json.dumps(to_encode)
 
 
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_ONE_US = timedelta(microseconds=1)
+
+EPOCH_FIELDS = {"s": "sent_epoch", "us": "sent_epoch_us",
+                "ns": "sent_epoch_ns"}
+_EPOCH_SCALES = {"sent_epoch_us": 1000000, "sent_epoch_ns": 1000000000}
+
+
+def get_epoch_field(dt, epoch_unit="s"):
+    """The name and value of the field storing ``dt`` in ``epoch_unit``"""
+    try:
+        epoch_field = EPOCH_FIELDS[epoch_unit]
+    except KeyError:
+        raise ValueError(f"Unknown epoch unit: {epoch_unit!r}") from None
+
+    if epoch_unit == "s":
+        return epoch_field, dt.timestamp()
+
+    epoch_us = (dt - _EPOCH) // _ONE_US
+    return epoch_field, epoch_us * 1000 if epoch_unit == "ns" else epoch_us
+
+
+def get_sent_seconds(decoded):
+    """Whole seconds since the epoch from an integer epoch field"""
+    for epoch_field, scale in _EPOCH_SCALES.items():
+        if epoch_field in decoded:
+            return decoded[epoch_field] // scale
+
+    raise KeyError("sent_epoch")
+
+
 ### Exercise: Write a function to display the encoded message
 def display_message(json_str: str) -> str:
     """Generate a display string for a JSON-encoded message"""
     decoded = json.loads(json_str)
 
     user_from = decoded["user_from"]
-    sent_ts = decoded["sent_epoch"]
     message = decoded["message"]
 
-    sent_dt = datetime.fromtimestamp(sent_ts)
+    if "sent_epoch" in decoded:
+        sent_dt = datetime.fromtimestamp(decoded["sent_epoch"])
+    else:
+        # Only whole seconds are displayed, so integer epochs can skip the
+        # conversion to a float timestamp
+        sent_dt = datetime.fromtimestamp(get_sent_seconds(decoded))
 
     return (f"({sent_dt:%Y-%m-%d %H:%M:%S}) {user_from}\n" +
             f"{message}")
@@ -86,30 +133,88 @@ def _parse_enum_level(levelstr):
 
 
 ### Bonus Exercise: Configure the logger to output timestamps in an ISO 8601 format
-def get_iso_logger(name):
+ISO_HANDLER_NAME = "iso"
+
+
+def get_iso_logger(name, use_queue=False, queue_size=10000,
+                   overflow="block"):
+    """
+    If ``use_queue`` is true, log calls only put the record on a queue of up
+    to ``queue_size`` records, which a background thread formats and writes
+    (see ``sd_logs.set_queue_handler`` for the ``overflow`` policies).
+
+    The handler added is named ``ISO_HANDLER_NAME``. Getting the logger
+    again replaces it, or reuses it if it is a queue handler and
+    ``use_queue`` is true, so each line is still only written once.
+    """
     # Get a logger
     logger = logging.getLogger(name)
-
-    ch = logging.StreamHandler()
-    logger.addHandler(ch)
     logger.setLevel(logging.DEBUG)
 
     formatter = IsoFormatter("{asctime} : {levelname} : {name} : {message}",
                              style="{")
-    ch.setFormatter(formatter)
+
+    if use_queue:
+        # sd_logs builds on this module, so it is only imported when needed
+        import sd_logs
+        sd_logs.set_queue_handler(logger, formatter, ISO_HANDLER_NAME,
+                                  queue_size=queue_size, overflow=overflow)
+    else:
+        ch = logging.StreamHandler()
+        ch.set_name(ISO_HANDLER_NAME)
+        ch.setFormatter(formatter)
+
+        _remove_handlers(logger, ISO_HANDLER_NAME)
+        logger.addHandler(ch)
 
     return logger
 
 
+def _remove_handlers(logger, name):
+    """Remove the handlers named ``name``, stopping any queue listeners"""
+    for handler in list(logger.handlers):
+        if handler.get_name() == name:
+            listener = getattr(handler, 'listener', None)
+            if listener is not None:
+                listener.stop()
+
+            logger.removeHandler(handler)
+
+
 class IsoFormatter(logging.Formatter):
     def __init__(self, fmt=None, tzinfo=tz.tzlocal(), style="%"):
         super().__init__(fmt=fmt, datefmt=None, style=style)
         self._tzinfo = tzinfo
+        self._cached_second = (None, None, None)
 
     def formatTime(self, record, *args, **kwargs):
-        dt = datetime.fromtimestamp(record.created, tz=self._tzinfo)
+        # Time zone transitions happen on whole seconds, so everything but
+        # the microseconds can be cached for the rest of the second.
+        seconds, microseconds = _split_timestamp(record.created)
+
+        cached_seconds, prefix, offset = self._cached_second
+        if seconds != cached_seconds:
+            dt = datetime.fromtimestamp(seconds, tz=self._tzinfo)
+            dt_str = dt.isoformat()
+            prefix, offset = dt_str[:19], dt_str[19:]
+            self._cached_second = (seconds, prefix, offset)
+
+        if microseconds:
+            return f"{prefix}.{microseconds:06d}{offset}"
+
+        return prefix + offset
+
+
+def _split_timestamp(ts):
+    """Split a timestamp into seconds and microseconds like fromtimestamp"""
+    frac, seconds = math.modf(ts)
+    microseconds = round(frac * 1e6)
+    if microseconds >= 1000000:
+        seconds, microseconds = seconds + 1, microseconds - 1000000
+    elif microseconds < 0:
+        seconds, microseconds = seconds - 1, microseconds + 1000000
 
-        return dt.isoformat()
+    return int(seconds), microseconds
 
 
 
@@ -120,12 +225,7 @@ class DatetimeEncoder(json.JSONEncoder):
         if isinstance(obj, datetime):
             tzi = obj.tzinfo
             if tzi is not None:
-                if hasattr(tzi, 'name'):
-                    tzi = tzi.name
-                elif tzi is timezone.utc or tzi is tz.UTC:
-                    tzi = "UTC"
-                else:
-                    raise ValueError("Time zone has no name to serialize")
+                tzi = get_tz_name(tzi)
 
             return {
                 'datetime': obj.replace(tzinfo=None).isoformat(),
@@ -135,26 +235,92 @@ class DatetimeEncoder(json.JSONEncoder):
 
         return super().default(obj)
 
-def get_annotated_tz(name):
+def get_tz_name(tzi):
+    """The name to serialize a time zone as, to be passed to `gettz`"""
+    if hasattr(tzi, 'name'):
+        return tzi.name
+    elif tzi is timezone.utc or tzi is tz.UTC:
+        return "UTC"
+
+    named = _ZONE_NAMES.get(id(tzi))
+    if named is not None:
+        return named[1]
+
+    # Only use a name that gets this same zone back
+    for name in _gettz_names(tzi):
+        try:
+            if _gettz(name) is tzi:
+                return name
+        except ValueError:
+            pass
+
+    raise ValueError("Time zone has no name to serialize")
+
+def _gettz_names(tzi):
+    """
+    Names that `gettz` may have loaded a zone from, for zones that didn't
+    come from `get_named_tz`. dateutil has no public way to get these,
+    so this relies on its private `_s` and `_filename` attributes and
+    `TZPATHS` (as in dateutil 2.7 to 2.9), and finds no names without them.
+    """
+    if isinstance(tzi, tz.tzstr):
+        names = [getattr(tzi, '_s', None)]
+    else:
+        filename = getattr(tzi, '_filename', None)
+        if not isinstance(tzi, tz.tzfile) or not filename:
+            return
+
+        names = [filename[len(path) + 1:]
+                 for path in getattr(tz.tz, 'TZPATHS', ())
+                 if filename.startswith(path + os.sep)]
+        names.append(filename)
+
+    yield from filter(None, names)
+
+MAX_NAMED_ZONES = 512
+_ZONE_NAMES = OrderedDict()     # id(zone) -> (zone, name it was got by)
+
+def get_named_tz(name):
     """
-    There is currently no supported way to get a string that can
-    be passed to `gettz` from the `tzinfo` object itself, so until
-    that is supported, hack this feature in.
+    The zone `gettz` returns for `name`. There is currently no
+    supported way to get a string that can be passed to `gettz`
+    from the `tzinfo` object itself, so rather than annotating the
+    zone (which `gettz` shares with every caller), the name is
+    remembered for `get_tz_name`, for up to `MAX_NAMED_ZONES` zones.
+
+    The zone is the one `gettz` returns, not a copy: datetimes in
+    an ambiguous or imaginary time only compare equal if their
+    `tzinfo` is the same object.
     """
+    tzi = _gettz(name)
+
+    # Keep the first name a zone was got by, e.g. for links to it
+    named = _ZONE_NAMES.pop(id(tzi), None) or (tzi, name)
+    _ZONE_NAMES[id(tzi)] = named
+    if len(_ZONE_NAMES) > MAX_NAMED_ZONES:
+        _ZONE_NAMES.popitem(last=False)
+
+    return tzi
+
+@functools.lru_cache(maxsize=512)
+def _gettz(name):
     tzi = tz.gettz(name)
-    if tzi is not tz.UTC:
-        tzi.name = name
+    if tzi is None:
+        raise ValueError(f"Unknown time zone: {name}")
 
     return tzi
 
+_DATETIME_KEYS = {'datetime', 'fold', 'timezone'}
+
 def decode_datetime_hook(obj):
-    if (isinstance(obj, dict) and len(obj) == 3 and
-        all(x in obj for x in ('datetime', 'fold', 'timezone'))):
-        # Decode a datetime from this
-        dt = datetime.fromisoformat(obj['datetime'])
-        fold = obj['fold']
-        tzi = obj['timezone']
-        if tzi is not None:
-            tzi = get_annotated_tz(tzi)
-
-        return dt.replace(fold=fold, tzinfo=tzi)
+    if len(obj) != 3 or obj.keys() != _DATETIME_KEYS:
+        return obj
+
+    # Decode a datetime from this
+    dt = datetime.fromisoformat(obj['datetime'])
+    fold = obj['fold']
+    tzi = obj['timezone']
+    if tzi is not None:
+        tzi = get_named_tz(tzi)
+
+    return dt.replace(fold=fold, tzinfo=tzi)
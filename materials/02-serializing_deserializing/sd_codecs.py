@@ -0,0 +1,258 @@
+"""
+A compact binary alternative to ``sd_answers.DatetimeEncoder``.
+
+A payload holds any number of datetimes, naive or aware, as columns::
+
+    b"DTB1"                          magic
+    uint32 n_zones, uint32 n_values
+    n_zones * (uint16 length, UTF-8 zone name)
+    n_values * int64                 local (wall) time, microseconds since
+                                     1970-01-01T00:00
+    n_values * uint16                (zone number << 1) | fold, where zone
+                                     number 0 means naive
+
+All integers are little-endian. As with the JSON encoding, aware datetimes
+are stored as wall time plus zone name, so they come back in the same zone
+(a ``get_named_tz`` zone), with the same fold.
+"""
+import codecs
+import json
+import re
+import struct
+
+from datetime import datetime
+
+import numpy as np
+
+import sd_answers
+
+MAGIC = b"DTB1"
+_HEADER = struct.Struct("<4sII")
+_NAME_LENGTH = struct.Struct("<H")
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+
+def _wall_us(dt):
+    days = dt.toordinal() - _EPOCH_ORDINAL
+    seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+    return (days * 86400 + seconds) * 1000000 + dt.microsecond
+
+
+def encode_datetimes(dts) -> bytes:
+    """Encode a sequence of datetimes as one binary payload"""
+    dts = list(dts)
+    zone_names = []
+    zone_tags = {}      # id(tzinfo) -> zone number << 1
+    tags = []
+    for dt in dts:
+        tzi = dt.tzinfo
+        if tzi is None:
+            tag = 0
+        else:
+            tag = zone_tags.get(id(tzi))
+            if tag is None:
+                name = sd_answers.get_tz_name(tzi)
+                if name not in zone_names:
+                    zone_names.append(name)
+
+                tag = zone_tags[id(tzi)] = (zone_names.index(name) + 1) << 1
+
+        tags.append(tag | dt.fold)
+
+    wall_us = np.fromiter(map(_wall_us, dts), dtype='<i8', count=len(tags))
+
+    parts = [_HEADER.pack(MAGIC, len(zone_names), len(tags))]
+    for name in zone_names:
+        name_bytes = name.encode('utf-8')
+        parts += [_NAME_LENGTH.pack(len(name_bytes)), name_bytes]
+
+    parts += [wall_us.tobytes(), np.array(tags, dtype='<u2').tobytes()]
+
+    return b''.join(parts)
+
+
+def decode_datetimes_array(data):
+    """
+    Decode a payload without creating datetime objects.
+
+    Returns the wall times as a ``datetime64[us]`` array, the folds, the
+    zone numbers (0 for naive datetimes) and the list of zone names, where
+    zone number ``i`` is ``zone_names[i - 1]``.
+    """
+    try:
+        magic, n_zones, n_values = _HEADER.unpack_from(data)
+    except struct.error:
+        magic = None
+
+    if magic != MAGIC:
+        raise ValueError("Not a binary datetime payload")
+
+    pos = _HEADER.size
+    zone_names = []
+    for _ in range(n_zones):
+        length, = _NAME_LENGTH.unpack_from(data, pos)
+        pos += _NAME_LENGTH.size
+        zone_names.append(bytes(data[pos:pos + length]).decode('utf-8'))
+        pos += length
+
+    if len(data) != pos + 10 * n_values:
+        raise ValueError("Binary datetime payload has the wrong length")
+
+    wall_us = np.frombuffer(data, dtype='<i8', count=n_values, offset=pos)
+    tags = np.frombuffer(data, dtype='<u2', count=n_values,
+                         offset=pos + 8 * n_values)
+
+    zones = tags >> 1
+    if n_values and zones.max() > n_zones:
+        raise ValueError("Binary datetime payload has an unknown zone")
+
+    return (wall_us.astype('datetime64[us]'), (tags & 1).astype(bool),
+            zones, zone_names)
+
+
+def decode_datetimes(data):
+    """Decode a binary payload back to a list of datetimes"""
+    wall, fold, zones, zone_names = decode_datetimes_array(data)
+
+    tzinfos = [None] + [sd_answers.get_named_tz(name)
+                        for name in zone_names]
+
+    dts = wall.astype(object).tolist()
+    zone_list = zones.tolist()
+    for i in np.flatnonzero(zones):
+        dt = dts[i]
+        dts[i] = datetime.combine(dt, dt.time(), tzinfos[zone_list[i]])
+
+    for i in np.flatnonzero(fold):
+        dts[i] = dts[i].replace(fold=1)
+
+    return dts
+
+
+def encode_datetime(dt) -> bytes:
+    return encode_datetimes([dt])
+
+
+def decode_datetime(data):
+    dts = decode_datetimes(data)
+    if len(dts) != 1:
+        raise ValueError(f"Expected a single datetime, got {len(dts)}")
+
+    return dts[0]
+
+
+### Streaming JSON
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])')
+
+
+class _StreamBuffer:
+    """Text read incrementally from a text or binary stream"""
+    def __init__(self, stream, chunk_size, encoding):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        """Read another chunk, discarding the text before ``pos``"""
+        # Read at least as much as is buffered, so that a value larger than
+        # the chunk size isn't reparsed once per chunk
+        size = max(self.chunk_size, len(self.text) - self.pos)
+        data = self.stream.read(size)
+        self.eof = not data
+        if isinstance(data, bytes):
+            # A chunk may end part way through a character
+            data = self.decoder.decode(data, final=self.eof)
+
+        self.text = self.text[self.pos:] + data
+        self.pos = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or self.eof:
+                return
+
+            self.read_more()
+
+    def next_char(self):
+        self.skip_whitespace()
+        return self.text[self.pos:self.pos + 1]
+
+
+def iter_json_array(stream, object_hook=sd_answers.decode_datetime_hook,
+                    chunk_size=65536, encoding='utf-8'):
+    """
+    Decode a JSON array from a text or binary stream (e.g. a file, or
+    ``socket.makefile('rb')``), yielding one element at a time.
+
+    Only one chunk of the stream and the element being decoded are held in
+    memory, however long the array is. By default, objects are decoded
+    with ``sd_answers.decode_datetime_hook``.
+    """
+    raw_decode = json.JSONDecoder(object_hook=object_hook).raw_decode
+    buf = _StreamBuffer(stream, chunk_size, encoding)
+
+    if buf.next_char() != '[':
+        raise ValueError("Expected a JSON array")
+
+    buf.pos += 1
+    if buf.next_char() == ']':
+        buf.pos += 1
+        _check_end(buf)
+        return
+
+    while True:
+        text, pos = buf.text, buf.pos
+        try:
+            value, end = raw_decode(text, _WHITESPACE.match(text, pos).end())
+        except json.JSONDecodeError:
+            if buf.eof:
+                raise
+
+            buf.read_more()
+            continue
+
+        # The separator also shows that a number didn't continue in the next
+        # chunk; if it isn't there (yet), read more and decode again.
+        sep = _SEPARATOR.match(text, end)
+        if sep is None or (sep.end() == len(text) and not buf.eof):
+            if buf.eof:
+                buf.pos = end
+                char = buf.next_char()
+                raise ValueError(f"Expected ',' or ']' in JSON array, got "
+                                 f"{char!r}" if char else
+                                 "Unexpected end of JSON array")
+
+            buf.read_more()
+            continue
+
+        buf.pos = sep.end()
+        yield value
+
+        if sep.group(1) == ']':
+            _check_end(buf)
+            return
+
+
+def _check_end(buf):
+    if buf.next_char():
+        raise ValueError("Extra data after JSON array")
+
+
+def iter_json_array_batches(stream, batch_size=10000, **kwargs):
+    """Like ``iter_json_array``, but yield lists of up to ``batch_size``"""
+    batch = []
+    for value in iter_json_array(stream, **kwargs):
+        batch.append(value)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -1,16 +1,37 @@
-from datetime import datetime, timedelta, tzinfo
+from datetime import date, tzinfo
 from dateutil import tz
 
-from io import BytesIO
 from base64 import b64decode
 
+from sd_tzif import TZifData, ZoneVersionRegistry
+
 class ChileTzInfo(tzinfo):
-    def __init__(self, access_date):
-        super().__init__()
-        if access_date < datetime(2016, 3, 20):
-            self._tzinfo = SANTIAGO_2016
-        else:
-            self._tzinfo = SANTIAGO
+    """
+    America/Santiago as it was known on ``access_date``.
+
+    All access dates that see the same version of the zone share one
+    instance, looked up in ``ZONE_VERSIONS``, which is identified by the
+    date that version took effect rather than by any one access date.
+    """
+    _instances = {}     # id(zone) -> (zone, instance)
+
+    def __new__(cls, access_date):
+        zone = ZONE_VERSIONS.get("America/Santiago", access_date)
+        try:
+            return cls._instances[id(zone)][1]
+        except KeyError:
+            pass
+
+        self = super().__new__(cls)
+        self._tzinfo = zone
+        self._effective_date = ZONE_VERSIONS.effective_date(
+            "America/Santiago", access_date)
+        cls._instances[id(zone)] = (zone, self)
+
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (self._effective_date,))
 
     def tzname(self, dt):
         return self._tzinfo.tzname(dt)
@@ -25,10 +46,10 @@ class ChileTzInfo(tzinfo):
         return "America/Santiago"
 
     def __repr__(self):
-        return f"{self.__class__.__name__}({self._access_date!r})"
+        return f"{self.__class__.__name__}({self._effective_date!r})"
 
 
-SANTIAGO_2016_DATA = BytesIO(b64decode("""
+SANTIAGO_2016_DATA = b64decode("""
 VFppZjIAAAAAAAAAAAAAAAAAAAAAAAAJAAAACQAAAAAAAAB0AAAACQAAABGAAAAAjzBHRptc5VCffOLG
 oQBxwLBed8axdz1AskEA0LNYcMC0IjRQtTmkQLYDZ9C3GtfAt+SbULj9XMC5xyBQzBxuQMxs59DT3I/A
 1BvJsNUzVcDVdpJA/dE8QP6S+rD/zM3AAHLcsAF1UMACQEmwA1UywAQgK7AFPk9ABgANsAcLvEAH3++w
@@ -61,7 +82,12 @@ AFU8VLABAgEDAQQCBAIEAgQCBAIDAgMFAwIDBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcG
 BwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcGBwYHBgcG
 CP//vboAAP//vboABP//ubAACP//x8AACP//x8ABDP//1dABDP//1dABDP//x8AACP//1dAACExNVABT
 TVQAQ0xUAENMU1QAAAAAAAAAAQEBAAAAAAAAAQEBCkNMVDMK
-""".replace('\n', '').strip().encode()))
+""".replace('\n', '').strip().encode())
 
 SANTIAGO = tz.gettz("America/Santiago")
-SANTIAGO_2016 = tz.tzfile(SANTIAGO_2016_DATA, filename="America/Santiago")
+SANTIAGO_2016 = TZifData(SANTIAGO_2016_DATA,
+                         filename="America/Santiago").tzinfo()
+
+ZONE_VERSIONS = ZoneVersionRegistry()
+ZONE_VERSIONS.add_zone("America/Santiago", date.min, SANTIAGO_2016)
+ZONE_VERSIONS.add_zone("America/Santiago", date(2016, 3, 20), SANTIAGO)
@@ -0,0 +1,999 @@
+"""
+Bulk versions of the log parsing answers in ``sd_answers``.
+
+Log files can be many gigabytes, so rather than reading them line by line
+these functions memory-map the file and parse it in chunks split on line
+boundaries, optionally spread across a pool of processes.
+
+On the writing side, ``set_queue_handler`` moves the formatting and writing
+of log records to a background thread that writes them in batches.
+"""
+import atexit
+import hashlib
+import io
+import logging
+import logging.handlers
+import mmap
+import os
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import numpy as np
+
+import sd_answers
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@contextmanager
+def open_log_buffer(source):
+    """
+    Get a read-only buffer with the contents of ``source``, which may be a
+    path or a binary stream.
+
+    Real files are memory-mapped; other streams (e.g. ``BytesIO``) are read
+    into memory. Either way the buffer holds the whole stream, from offset
+    0, unless the stream can't seek.
+    """
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            with open_log_buffer(f) as buf:
+                yield buf
+        return
+
+    try:
+        fileno = source.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        fileno = None
+
+    if fileno is None or os.fstat(fileno).st_size == 0:
+        # mmap can't map empty files
+        if source.seekable():
+            source.seek(0)
+
+        yield source.read()
+        return
+
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as buf:
+        yield buf
+
+
+class TimestampParserStats(NamedTuple):
+    hits: int
+    misses: int
+    fallbacks: int
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses + self.fallbacks
+        return self.hits / total if total else 0.0
+
+
+def _is_iso_layout(dt_str):
+    # YYYY-MM-DDTHH:MM:SS[.ffffff]+HH:MM, as written by IsoFormatter
+    n = len(dt_str)
+    return ((n == 25 or (n == 32 and dt_str[19] == '.')) and
+            dt_str[10] == 'T' and dt_str[13] == ':' and dt_str[16] == ':')
+
+
+class IsoTimestampParser:
+    """
+    Parse the timestamps written by ``sd_answers.IsoFormatter``.
+
+    ``datetime.fromisoformat`` creates a new ``timezone`` for every string it
+    parses, even though a log file only contains a handful of distinct UTC
+    offsets. This parser remembers the offsets it has seen and attaches the
+    same ``timezone`` object to every timestamp with that offset, parsing
+    only the local date and time that precede it.
+
+    This is opt-in (see ``LogLineParser``): the C ``fromisoformat`` parses a
+    whole timestamp faster than any prefix cache in Python can (about 250 ns
+    against 2 us), so it only pays off when many parsed records are kept in
+    memory. ``stats()`` reports how often the cached offsets were used.
+    Anything not in the ``YYYY-MM-DDTHH:MM:SS[.ffffff]+HH:MM`` format is
+    passed straight to ``datetime.fromisoformat``.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._timezones = {}
+        self.hits = self.misses = self.fallbacks = 0
+
+    def stats(self):
+        return TimestampParserStats(self.hits, self.misses, self.fallbacks)
+
+    def __call__(self, dt_str):
+        if not _is_iso_layout(dt_str):
+            self.fallbacks += 1
+            return datetime.fromisoformat(dt_str)
+
+        tzi = self._timezones.get(dt_str[-6:])
+        if tzi is not None:
+            dt = datetime.fromisoformat(dt_str[:-6])
+            if dt.tzinfo is None:
+                self.hits += 1
+                return datetime.combine(dt, dt.time(), tzi)
+
+        self.misses += 1
+        dt = datetime.fromisoformat(dt_str)
+        if dt.tzinfo is None:
+            return dt
+
+        tzi = self._timezones.setdefault(dt_str[-6:], dt.tzinfo)
+        return datetime.combine(dt, dt.time(), tzi)
+
+
+class LogLineParser:
+    """
+    Equivalent to ``sd_answers.parse_log_line`` (or, with ``enum_levels``,
+    ``parse_log_line_enum``), but using an ``IsoTimestampParser``.
+
+    Instances can be passed as the ``parser`` to ``iter_log_batches``; with
+    a process pool each worker gets its own copy, and its own statistics.
+    """
+    def __init__(self, enum_levels=False):
+        self.enum_levels = enum_levels
+        self.parse_timestamp = IsoTimestampParser()
+
+    def __call__(self, line):
+        dt_str, level_str, name, message = line.split(' : ', 4)
+        dt = self.parse_timestamp(dt_str)
+
+        if self.enum_levels:
+            level = sd_answers._parse_enum_level(level_str.strip())
+        else:
+            level = level_str
+
+        return {
+            'datetime': dt,
+            'level': level,
+            'name': name,
+            'message': message,
+        }
+
+
+def chunk_bounds(buf, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split ``buf`` into ``(start, end)`` ranges of roughly ``chunk_size``
+    bytes, each ending just after a newline (or at the end of the buffer).
+    """
+    bounds = []
+    start, size = 0, len(buf)
+    while start < size:
+        end = buf.find(b'\n', min(start + chunk_size, size) - 1)
+        end = size if end < 0 else end + 1
+        bounds.append((start, end))
+        start = end
+
+    return bounds
+
+
+def _split_lines(chunk, encoding):
+    # Split only on "\n" (and "\r\n"), as reading the file in text mode
+    # would: str.splitlines() also splits on characters like "\x1c" that
+    # may legitimately appear in a message.
+    lines = chunk.decode(encoding).split('\n')
+    return [line[:-1] if line.endswith('\r') else line
+            for line in lines if line and line != '\r']
+
+
+def parse_log_chunk(chunk, parser=sd_answers.parse_log_line,
+                    encoding='utf-8'):
+    """Parse every non-blank line in a chunk of bytes"""
+    return [parser(line) for line in _split_lines(chunk, encoding)]
+
+
+def _parse_file_range(path, start, end, parser, encoding):
+    # Run in worker processes, which map the file themselves rather than
+    # having the chunk pickled and sent to them.
+    with open_log_buffer(path) as buf:
+        return parse_log_chunk(buf[start:end], parser, encoding)
+
+
+def _parse_chunks(source, buf, bounds, parser, encoding, processes):
+    if not processes:
+        for start, end in bounds:
+            yield parse_log_chunk(buf[start:end], parser, encoding)
+        return
+
+    if isinstance(source, (str, bytes, os.PathLike)):
+        def submit(start, end):
+            return executor.submit(_parse_file_range, source, start, end,
+                                   parser, encoding)
+    else:
+        def submit(start, end):
+            return executor.submit(parse_log_chunk, buf[start:end], parser,
+                                   encoding)
+
+    # Only a few chunks are in flight at once, so that neither the chunks
+    # sent to the workers nor their results pile up in memory. Results come
+    # back in file order regardless of which worker finished first.
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for start, end in bounds:
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+
+            pending.append(submit(start, end))
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_log_batches(source, batch_size=10000,
+                     parser=sd_answers.parse_log_line, processes=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+    """
+    Parse a log file, yielding lists of up to ``batch_size`` records.
+
+    Each non-blank line (without its line ending) is passed to ``parser``,
+    which defaults to ``sd_answers.parse_log_line`` and may be any picklable
+    function taking a line, such as ``sd_answers.parse_log_line_enum``.
+
+    If ``processes`` is given, chunks of ``chunk_size`` bytes are parsed in
+    a pool with that many worker processes. The records are yielded in file
+    order either way.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+
+    with open_log_buffer(source) as buf:
+        bounds = chunk_bounds(buf, chunk_size)
+
+        batch = []
+        for records in _parse_chunks(source, buf, bounds, parser, encoding,
+                                     processes):
+            batch.extend(records)
+            full = len(batch) - len(batch) % batch_size
+            for i in range(0, full, batch_size):
+                yield batch[i:i + batch_size]
+
+            batch = batch[full:]
+
+        if batch:
+            yield batch
+
+
+def iter_log_records(source, **kwargs):
+    """Parse a log file, yielding one record at a time"""
+    for batch in iter_log_batches(source, **kwargs):
+        yield from batch
+
+
+### Columnar parsing
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+
+class LogColumns:
+    """
+    A parsed log file stored as columns rather than one dict per line.
+
+    - ``utc_us``: ``int64`` microseconds since the epoch (UTC)
+    - ``utcoffset_us``: ``int64`` UTC offset of each timestamp, in
+      microseconds
+    - ``level``: ``int32`` level codes, as from ``parse_log_line_enum``
+    - ``name_code``: ``int32`` indices into the list ``names``
+    - ``message_start``, ``message_end``: ``int64`` byte offsets of each
+      message in ``buffer``
+
+    Indexing with a slice, an integer array or a boolean mask (e.g.
+    ``cols[cols.level >= logging.WARNING]``) selects rows without copying
+    the messages out of the buffer.
+    """
+    def __init__(self, utc_us, utcoffset_us, level, name_code, names,
+                 message_start, message_end, buffer, encoding='utf-8'):
+        self.utc_us = utc_us
+        self.utcoffset_us = utcoffset_us
+        self.level = level
+        self.name_code = name_code
+        self.names = names
+        self.message_start = message_start
+        self.message_end = message_end
+        self.buffer = buffer
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.utc_us)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            raise TypeError("Use record() to get a single row")
+
+        return self.__class__(self.utc_us[key], self.utcoffset_us[key],
+                              self.level[key], self.name_code[key],
+                              self.names, self.message_start[key],
+                              self.message_end[key], self.buffer,
+                              self.encoding)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} with {len(self)} rows>"
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.utc_us, self.utcoffset_us,
+                                          self.level, self.name_code,
+                                          self.message_start,
+                                          self.message_end))
+
+    def name_mask(self, name):
+        """Boolean mask of the rows logged by ``name``"""
+        try:
+            code = self.names.index(name)
+        except ValueError:
+            return np.zeros(len(self), dtype=bool)
+
+        return self.name_code == code
+
+    def to_datetime64(self, local=False):
+        """The timestamps as UTC (or local) ``datetime64[us]`` values"""
+        us = self.utc_us + self.utcoffset_us if local else self.utc_us
+        return us.astype('datetime64[us]')
+
+    def message(self, i):
+        start, end = self.message_start[i], self.message_end[i]
+        return self.buffer[start:end].decode(self.encoding)
+
+    def record(self, i):
+        """Row ``i`` as a dict like the ones from ``parse_log_line_enum``"""
+        tzi = timezone(timedelta(microseconds=int(self.utcoffset_us[i])))
+        dt = _EPOCH + timedelta(microseconds=int(self.utc_us[i]))
+
+        return {
+            'datetime': dt.astimezone(tzi),
+            'level': int(self.level[i]),
+            'name': self.names[self.name_code[i]],
+            'message': self.message(i),
+        }
+
+
+# Timestamps are parsed from matrices this wide, and other fields are kept
+# in matrices if they are no wider than _MAX_FIELD_WIDTH
+_TIMESTAMP_WIDTH = 32
+_MAX_FIELD_WIDTH = 256
+
+# Columns of "YYYY-MM-DDTHH:MM:SS.ffffff" that must be digits
+_DIGIT_COLS = np.array([0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18])
+_FRACTION_COLS = np.arange(20, 26)
+
+
+def _timestamp_layout(mat, lens):
+    """Which rows of a byte matrix are in the IsoFormatter layout"""
+    def is_digit(cols):
+        return ((cols >= ord('0')) & (cols <= ord('9'))).all(axis=1)
+
+    long_ = (lens == 32) & (mat[:, 19] == ord('.'))
+    return (((lens == 25) | long_) &
+            (mat[:, 4] == ord('-')) & (mat[:, 7] == ord('-')) &
+            (mat[:, 10] == ord('T')) &
+            (mat[:, 13] == ord(':')) & (mat[:, 16] == ord(':')) &
+            is_digit(mat[:, _DIGIT_COLS]) &
+            (is_digit(mat[:, _FRACTION_COLS]) | ~long_))
+
+
+def _field_matrix(arr, starts, ends, width):
+    """
+    Copy byte ranges of ``arr`` into the rows of a zero-padded matrix,
+    truncating them to ``width`` bytes
+    """
+    lens = ends - starts
+    cols = np.arange(width)
+    idx = np.minimum(starts[:, np.newaxis] + cols, len(arr) - 1)
+    return np.where(cols < lens[:, np.newaxis], arr[idx], 0).astype(np.uint8)
+
+
+def _field_column(arr, starts, ends):
+    """
+    Byte ranges of ``arr`` as a matrix as wide as the longest, or as a list
+    of bytes if one is too long for a matrix of them to be reasonable
+    """
+    width = int((ends - starts).max())
+    if width > _MAX_FIELD_WIDTH:
+        return [arr[start:end].tobytes()
+                for start, end in zip(starts.tolist(), ends.tolist())]
+
+    return _field_matrix(arr, starts, ends, max(width, 1))
+
+
+def _timestamp_matrix(values):
+    """A sequence of bytes as a zero-padded matrix, truncated to 32 wide"""
+    mat = np.array(values, dtype=f'S{_TIMESTAMP_WIDTH}').view(np.uint8)
+    return mat.reshape(len(values), _TIMESTAMP_WIDTH)
+
+
+def _unique_rows(mat):
+    """The distinct rows of a byte matrix as bytes, plus the inverse"""
+    rows = mat.view(f'S{mat.shape[1]}').ravel()
+    uniques, inverse = np.unique(rows, return_inverse=True)
+    return uniques, inverse.ravel()
+
+
+def _parse_aware(dt_bytes, encoding):
+    """Parse one timestamp with ``fromisoformat``, requiring a UTC offset"""
+    dt = datetime.fromisoformat(dt_bytes.decode(encoding))
+    if dt.tzinfo is None:
+        raise ValueError(f"Timestamp has no UTC offset: {dt_bytes}")
+
+    return dt
+
+
+def _parse_timestamps(mat, lens, get_bytes, offsets, encoding):
+    """
+    Parse timestamps to UTC and offset microseconds. ``mat`` holds them
+    truncated to 32 bytes, ``lens`` their lengths and ``get_bytes(i)``
+    returns a whole timestamp; ``offsets`` caches the offset suffixes seen
+    so far.
+
+    Timestamps in the IsoFormatter layout are parsed as one array by numpy;
+    any others are parsed one at a time with ``fromisoformat``.
+    """
+    n = len(lens)
+    layout = _timestamp_layout(mat, lens)
+    offset_us = np.zeros(n, dtype=np.int64)
+    wall_us = np.zeros(n, dtype=np.int64)
+
+    for i in np.flatnonzero(~layout):
+        dt = _parse_aware(get_bytes(i), encoding)
+        offset_us[i] = dt.utcoffset() // _ONE_US
+        wall_us[i] = (dt.replace(tzinfo=None) - _EPOCH_NAIVE) // _ONE_US
+
+    rows = np.flatnonzero(layout)
+    if not len(rows):
+        return wall_us - offset_us, offset_us
+
+    # Split off the offsets, leaving naive ISO strings for numpy to parse
+    wall = mat[rows]
+    short = (lens[rows] == 25)[:, np.newaxis]
+    suffixes, inverse = _unique_rows(np.where(short, wall[:, 19:25],
+                                              wall[:, 26:32]))
+    suffix_us = np.empty(len(suffixes), dtype=np.int64)
+    for j, suffix in enumerate(suffixes):
+        if suffix not in offsets:
+            # Validate the offset by parsing the first timestamp with it
+            i = rows[np.argmax(inverse == j)]
+            dt = _parse_aware(get_bytes(i), encoding)
+            offsets[suffix] = dt.utcoffset() // _ONE_US
+
+        suffix_us[j] = offsets[suffix]
+
+    wall[:, 19:] *= ~short
+    wall[:, 26:] = 0
+
+    offset_us[rows] = suffix_us[inverse]
+    try:
+        wall_us[rows] = (wall.view(f'S{wall.shape[1]}').ravel()
+                         .astype('datetime64[us]').astype(np.int64))
+    except ValueError:
+        # Raise the same error parse_log_line would
+        for i in rows:
+            datetime.fromisoformat(get_bytes(i).decode(encoding))
+        raise
+
+    return wall_us - offset_us, offset_us
+
+
+def _split_lines_array(arr):
+    """Start and end of each non-blank line, without its line ending"""
+    newlines = np.flatnonzero(arr == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(arr)]))
+
+    has_cr = ends > starts
+    has_cr[has_cr] = arr[ends[has_cr] - 1] == ord('\r')
+    ends -= has_cr
+
+    nonblank = ends > starts
+    return starts[nonblank], ends[nonblank]
+
+
+def _split_fields_array(arr, starts, ends):
+    """
+    The positions of the three " : " separators in each line, or None if
+    the chunk has to be split line by line (e.g. because a line is invalid)
+    """
+    seps = np.flatnonzero((arr[:-2] == ord(' ')) & (arr[1:-1] == ord(':')) &
+                          (arr[2:] == ord(' ')))
+
+    # Overlapping separators (" : : ") are resolved by str.split
+    if len(seps) != 3 * len(starts) or (np.diff(seps) < 3).any():
+        return None
+
+    seps = seps.reshape(-1, 3)
+    if not ((seps[:, 0] >= starts) & (seps[:, 2] + 3 <= ends)).all():
+        return None
+
+    return seps
+
+
+def _split_fields_python(chunk, encoding):
+    """The same as ``_split_fields_array``, one line at a time"""
+    pos = 0
+    dt_col, level_col, name_col, msg_start, msg_end = [], [], [], [], []
+    for line in chunk.split(b'\n'):
+        line_start, pos = pos, pos + len(line) + 1
+        if line.endswith(b'\r'):
+            line = line[:-1]
+
+        if not line:
+            continue
+
+        dt_bytes, level_bytes, name_bytes, message = line.split(b' : ', 4)
+        dt_col.append(dt_bytes)
+        level_col.append(level_bytes)
+        name_col.append(name_bytes)
+        msg_end.append(line_start + len(line))
+        msg_start.append(msg_end[-1] - len(message))
+
+    return (_timestamp_matrix(dt_col),
+            np.fromiter(map(len, dt_col), dtype=np.int64, count=len(dt_col)),
+            dt_col.__getitem__, level_col, name_col,
+            np.array(msg_start, dtype=np.int64),
+            np.array(msg_end, dtype=np.int64))
+
+
+def _encode_column(values, table, make_value):
+    """Dictionary-encode ``values`` (bytes) using (and updating) ``table``"""
+    if isinstance(values, np.ndarray):
+        uniques, inverse = _unique_rows(values)
+    else:
+        uniques = list(dict.fromkeys(values))
+        inverse = np.fromiter(map({u: i for i, u in enumerate(uniques)}.get,
+                                  values),
+                              dtype=np.int64, count=len(values))
+
+    for value in uniques:
+        if value not in table:
+            table[value] = make_value(value)
+
+    codes = np.array([table[value] for value in uniques], dtype=np.int32)
+    return codes[inverse]
+
+
+def _parse_column_chunk(chunk, pos, state, encoding):
+    offsets, levels, names = state
+    arr = np.frombuffer(chunk, dtype=np.uint8)
+
+    starts, ends = _split_lines_array(arr)
+    if not len(starts):
+        return None
+
+    seps = _split_fields_array(arr, starts, ends)
+    if seps is None or not arr.all():
+        # Fall back to splitting in Python for unusual lines, or if there are
+        # NUL bytes, which don't survive conversion to numpy byte strings
+        (dt_mat, dt_lens, dt_bytes, level_col, name_col, msg_start,
+         msg_end) = _split_fields_python(chunk, encoding)
+    else:
+        dt_mat = _field_matrix(arr, starts, seps[:, 0], _TIMESTAMP_WIDTH)
+        dt_lens = seps[:, 0] - starts
+
+        def dt_bytes(i):
+            return arr[starts[i]:seps[i, 0]].tobytes()
+
+        level_col = _field_column(arr, seps[:, 0] + 3, seps[:, 1])
+        name_col = _field_column(arr, seps[:, 1] + 3, seps[:, 2])
+        msg_start, msg_end = seps[:, 2] + 3, ends
+
+    utc_us, offset_us = _parse_timestamps(dt_mat, dt_lens, dt_bytes, offsets,
+                                          encoding)
+
+    def parse_level(level_bytes):
+        return sd_answers._parse_enum_level(level_bytes.decode(encoding)
+                                            .strip())
+
+    return (utc_us, offset_us,
+            _encode_column(level_col, levels, parse_level),
+            _encode_column(name_col, names, lambda name: len(names)),
+            msg_start + pos, msg_end + pos)
+
+
+def parse_log_columns(buf, chunk_size=DEFAULT_CHUNK_SIZE, encoding='utf-8'):
+    """
+    Parse a whole log file into ``LogColumns``.
+
+    ``buf`` is a bytes-like object, e.g. from ``open_log_buffer``; since the
+    messages are read from it on demand, it has to stay open as long as the
+    columns are used. Lines are interpreted as by ``parse_log_line_enum``,
+    and every timestamp must have a UTC offset.
+
+    The lines are split with numpy, without creating an object per line, so
+    ``encoding`` must be ASCII-compatible (e.g. UTF-8 or Latin-1).
+    """
+    state = ({}, {}, {})
+    chunks = [_parse_column_chunk(buf[start:end], start, state, encoding)
+              for start, end in chunk_bounds(buf, chunk_size)]
+    chunks = [chunk for chunk in chunks if chunk is not None]
+
+    if chunks:
+        columns = [np.concatenate(col) for col in zip(*chunks)]
+    else:
+        columns = [np.array([], dtype=dtype) for dtype in
+                   (np.int64, np.int64, np.int32, np.int32, np.int64,
+                    np.int64)]
+
+    utc_us, offset_us, level, name_code, msg_start, msg_end = columns
+    names = [name.decode(encoding) for name in state[2]]
+
+    return LogColumns(utc_us, offset_us, level, name_code, names,
+                      msg_start, msg_end, buf, encoding)
+
+
+### Time range queries
+_MAX_TIMESTAMP_LEN = 64
+_INDEX_HEAD_SIZE = 4096
+DEFAULT_INDEX_STEP = 64 * 1024
+
+
+def _next_line_start(buf, pos):
+    """The start of the first line starting at or after ``pos``"""
+    if pos <= 0:
+        return 0
+
+    end = buf.find(b'\n', pos - 1)
+    return len(buf) if end < 0 else end + 1
+
+
+def _line_timestamp(buf, start, encoding):
+    """The timestamp of the line at ``start``, or None if it has none"""
+    end = buf.find(b' : ', start, start + _MAX_TIMESTAMP_LEN)
+    if end < 0:
+        return None
+
+    try:
+        return datetime.fromisoformat(bytes(buf[start:end]).decode(encoding))
+    except ValueError:
+        # e.g. a line of a traceback, which belongs to the record before
+        return None
+
+
+def _next_timestamp(buf, pos, encoding):
+    """The first timestamped line starting at or after ``pos``"""
+    start = _next_line_start(buf, pos)
+    while start < len(buf):
+        dt = _line_timestamp(buf, start, encoding)
+        if dt is not None:
+            return start, dt
+
+        start = _next_line_start(buf, start + 1)
+
+    return len(buf), None
+
+
+def _seek_time(buf, target, lo, hi, encoding):
+    """
+    The start of the first line in ``buf[lo:hi]`` timestamped at or after
+    ``target``, given that there is none before ``lo`` and that ``hi`` is a
+    line start from which every timestamp is at or after ``target``.
+    """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        _, dt = _next_timestamp(buf, mid, encoding)
+        if dt is None or dt >= target:
+            hi = mid
+        else:
+            lo = mid + 1
+
+    return _next_timestamp(buf, lo, encoding)[0]
+
+
+def _head_digest(buf, size):
+    """A digest of the first block of ``buf[:size]``"""
+    return hashlib.sha1(bytes(buf[:min(size, _INDEX_HEAD_SIZE)])).hexdigest()
+
+
+class TimeIndex(NamedTuple):
+    """
+    A sparse index of a time-ordered log file: the UTC time and offset of
+    the first timestamped line in each block of the file, and the size of
+    the file and a digest of its first block when it was indexed.
+    """
+    utc_us: np.ndarray
+    offsets: np.ndarray
+    size: int
+    head: str
+
+    def matches(self, buf):
+        """
+        Whether this indexes ``buf``, or the start of it before lines were
+        appended, rather than e.g. a file rotated into its place
+        """
+        return (self.size <= len(buf) and
+                _head_digest(buf, self.size) == self.head)
+
+    def bounds(self, target, size):
+        """Offsets to search between for the first line at ``target``"""
+        target_us = (target - _EPOCH) // _ONE_US
+        i = np.searchsorted(self.utc_us, target_us, side='left')
+        lo = int(self.offsets[i - 1]) if i else 0
+        hi = int(self.offsets[i]) if i < len(self.offsets) else size
+
+        return lo, hi
+
+
+def build_time_index(buf, step=DEFAULT_INDEX_STEP, encoding='utf-8'):
+    """
+    Index ``buf``, parsing only one timestamp per ``step`` bytes. The
+    timestamps must have UTC offsets.
+    """
+    utc_us, offsets = [], []
+    for pos in range(0, len(buf), step):
+        start, dt = _next_timestamp(buf, pos, encoding)
+        if dt is None:
+            break
+
+        if not offsets or start > offsets[-1]:
+            utc_us.append((dt - _EPOCH) // _ONE_US)
+            offsets.append(start)
+
+    return TimeIndex(np.array(utc_us, dtype=np.int64),
+                     np.array(offsets, dtype=np.int64), len(buf),
+                     _head_digest(buf, len(buf)))
+
+
+def save_time_index(index, path):
+    with open(path, 'wb') as f:
+        np.savez(f, utc_us=index.utc_us, offsets=index.offsets,
+                 size=index.size, head=index.head)
+
+
+def load_time_index(path):
+    with np.load(path) as data:
+        return TimeIndex(data['utc_us'], data['offsets'], int(data['size']),
+                         str(data['head']))
+
+
+def get_time_index(path, buf, step=DEFAULT_INDEX_STEP, encoding='utf-8'):
+    """
+    Get the index for the log file at ``path`` (mapped as ``buf``) from the
+    sidecar file ``path + '.tidx'``, building and saving it if it is
+    missing or stale (or only building it, if it can't be saved).
+
+    Log files are only appended to, so an index of a smaller file with the
+    same first block is still valid for the part it covers, and is only
+    rebuilt if the unindexed part is more than a hundred ``step``\\s.
+    """
+    index_path = os.fspath(path) + '.tidx'
+    try:
+        index = load_time_index(index_path)
+    except (OSError, ValueError, KeyError):
+        index = None
+
+    if (index is None or not index.matches(buf) or
+            len(buf) - index.size > 100 * step):
+        index = build_time_index(buf, step, encoding)
+        try:
+            save_time_index(index, index_path)
+        except OSError:
+            # e.g. a read-only log directory: use the index unsaved
+            pass
+
+    return index
+
+
+def find_time_range(buf, start=None, end=None, index=None,
+                    encoding='utf-8'):
+    """
+    Find the ``(begin, end)`` byte offsets of the lines of a time-ordered
+    log file timestamped in ``[start, end)``, binary searching the file and
+    parsing only the timestamps needed with ``fromisoformat``.
+
+    Lines without a timestamp (e.g. tracebacks) go with the line before.
+    ``index`` is an optional ``TimeIndex`` of ``buf`` to narrow the search.
+    """
+    bounds = []
+    for target in (start, end):
+        if target is None:
+            bounds.append(len(buf) if bounds else 0)
+            continue
+
+        lo, hi = 0, len(buf)
+        if index is not None and index.matches(buf):
+            lo, hi = index.bounds(target, len(buf))
+
+        bounds.append(_seek_time(buf, target, lo, hi, encoding))
+
+    begin, end = bounds
+    return begin, max(begin, end)
+
+
+def query_time_range(source, start=None, end=None, use_index=False,
+                     encoding='utf-8'):
+    """
+    Get the lines of a time-ordered log file timestamped in ``[start, end)``,
+    e.g. as written by ``sd_answers.get_iso_logger``.
+
+    If ``use_index`` is true and ``source`` is a path, a sparse index is
+    kept in a sidecar file (see ``get_time_index``) for repeat queries.
+    """
+    with open_log_buffer(source) as buf:
+        index = None
+        if use_index and isinstance(source, (str, os.PathLike)):
+            index = get_time_index(source, buf, encoding=encoding)
+
+        begin, end = find_time_range(buf, start, end, index, encoding)
+
+        return _split_lines(buf[begin:end], encoding)
+
+
+### Queued logging
+def set_queue_handler(logger, formatter, name, queue_size=10000,
+                      overflow="block"):
+    """
+    Make ``logger`` put its records on a queue of up to ``queue_size``
+    records, from which a background thread formats them with
+    ``formatter`` and writes them to stderr in batches. When the queue is
+    full, ``overflow`` says whether to "block", "drop_oldest" or
+    "drop_newest"; the ``OverflowQueueHandler`` returned counts the records
+    queued and dropped.
+
+    The queue handler is named ``name``. If the logger already has an
+    ``OverflowQueueHandler`` with that name it is reused (with its queue and
+    listener); any other handlers with that name are removed.
+    """
+    for handler in logger.handlers:
+        if (isinstance(handler, OverflowQueueHandler) and
+                handler.get_name() == name):
+            handler.listener.start()
+            return handler
+
+    sd_answers._remove_handlers(logger, name)
+
+    ch = BatchStreamHandler()
+    ch.setFormatter(formatter)
+
+    qh = OverflowQueueHandler(queue.Queue(queue_size), overflow=overflow)
+    qh.set_name(name)
+    qh.listener = BatchQueueListener(qh.queue, ch)
+    qh.listener.start()
+    atexit.register(qh.listener.stop)
+
+    logger.addHandler(qh)
+    return qh
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """A StreamHandler that can also write many records at once"""
+    def handle_batch(self, records):
+        records = [record for record in records
+                   if record.levelno >= self.level and self.filter(record)]
+        if not records:
+            return
+
+        self.acquire()
+        try:
+            try:
+                self.stream.write(''.join(self.format(record) + self.terminator
+                                          for record in records))
+                self.flush()
+            except Exception:
+                # One failed write, so report it once for the whole batch
+                self.handleError(records[0])
+        finally:
+            self.release()
+
+
+class BatchQueueListener:
+    """
+    Like ``logging.handlers.QueueListener`` (with ``respect_handler_level``),
+    but takes everything waiting in the queue (up to ``batch_size`` records)
+    and passes it to its handlers in one go.
+
+    Handlers with a ``handle_batch`` method get the whole batch; others get
+    one record at a time.
+    """
+    _STOP = object()
+
+    def __init__(self, queue, *handlers, batch_size=1000):
+        self.queue = queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record
+
+    def start(self):
+        """Start the background thread, unless it is already running"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Handle everything already queued, then stop the thread"""
+        with self._lock:
+            if self._thread is not None:
+                # Wait for room, rather than failing if the queue is full
+                self.queue.put(self._STOP)
+                self._thread.join()
+                self._thread = None
+
+    def handle_batch(self, records):
+        records = [self.prepare(record) for record in records]
+        for handler in self.handlers:
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(records)
+            else:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+    def _run(self):
+        has_task_done = hasattr(self.queue, 'task_done')
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            n_dequeued = len(batch)
+            if self._STOP in batch:
+                batch = batch[:batch.index(self._STOP)]
+                stopping = True
+
+            self.handle_batch(batch)
+
+            if has_task_done:
+                for _ in range(n_dequeued):
+                    self.queue.task_done()
+
+
+class OverflowQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler for a bounded queue. When the queue is full, ``overflow``
+    decides whether to "block" until there is room, "drop_oldest" to make
+    room, or "drop_newest" (the record being logged).
+
+    Every record handled is counted in either ``queued`` or ``dropped``.
+    """
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, queue, overflow="block"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        super().__init__(queue)
+        self.overflow = overflow
+        self.queued = 0
+        self.dropped = 0
+
+    def enqueue(self, record):
+        # Called with the handler lock held, so the counters are consistent
+        if self.overflow == "block":
+            self.queue.put(record)
+        elif self.overflow == "drop_newest":
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(record)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        continue
+
+                    # The oldest record is dropped instead of this one
+                    self.queue.task_done()
+                    self.queued -= 1
+                    self.dropped += 1
+
+        self.queued += 1
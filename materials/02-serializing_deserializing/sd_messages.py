@@ -0,0 +1,168 @@
+"""
+Bulk versions of the message answers in ``sd_answers``.
+
+Messages are stored as JSON Lines: one ``sd_answers.encode_message`` object
+per line. Encoding reads the clock once per batch rather than once per
+message, and decoding converts all of the epochs to local time at once.
+"""
+import calendar
+import itertools
+import json
+import time
+
+from datetime import datetime, timezone
+from json.encoder import encode_basestring_ascii as _quote
+
+import numpy as np
+
+import sd_answers
+
+_HOUR = 3600
+
+# Local times that numpy and strftime('%Y') format the same way
+_MIN_SECONDS = -30610224000     # 1000-01-01T00:00:00
+_MAX_SECONDS = 253402300799     # 9999-12-31T23:59:59
+
+
+def _utc_now():
+    return datetime.now(timezone.utc)
+
+
+def encode_messages(messages, clock=None, epoch_unit="s") -> str:
+    """
+    Encode an iterable of ``(user_to, user_from, message)`` tuples as JSON
+    Lines, each line as ``sd_answers.encode_message`` would encode it.
+
+    The clock is read once, so every message in the batch has the same
+    ``sent_epoch``. ``clock`` is a function returning an aware datetime;
+    by default it is the current time. ``epoch_unit`` is as for
+    ``encode_message``.
+    """
+    epoch_field, epoch = sd_answers.get_epoch_field((clock or _utc_now)(),
+                                                    epoch_unit)
+    sent_epoch = f'"{epoch_field}": {json.dumps(epoch)}'
+
+    return ''.join([
+        f'{{"user_to": {_quote(user_to)}, '
+        f'"user_from": {_quote(user_from)}, '
+        f'{sent_epoch}, "message": {_quote(message)}}}\n'
+        for user_to, user_from, message in messages])
+
+
+def write_messages(stream, messages, batch_size=10000, clock=None,
+                   epoch_unit="s"):
+    """
+    Write an iterable of messages to a text stream as JSON Lines, reading
+    the clock once per batch of ``batch_size`` messages.
+    """
+    messages = iter(messages)
+    while True:
+        batch = list(itertools.islice(messages, batch_size))
+        if not batch:
+            return
+
+        stream.write(encode_messages(batch, clock=clock,
+                                     epoch_unit=epoch_unit))
+
+
+def _local_offset(seconds):
+    """The local UTC offset in seconds at a time, according to the OS"""
+    return calendar.timegm(time.localtime(seconds)) - seconds
+
+
+def local_time_strings(epochs) -> list:
+    """
+    Format epoch timestamps as ``datetime.fromtimestamp(ts)`` would with
+    ``'%Y-%m-%d %H:%M:%S'``, i.e. in the local zone. An integer array is
+    taken to be whole seconds.
+
+    Rather than asking the OS for the local time of every timestamp, this
+    looks up the offset at the start and end of each distinct hour, and
+    only looks at individual timestamps in hours where the offset changes.
+    """
+    epochs = np.asarray(epochs)
+    if epochs.dtype.kind not in 'iu':
+        epochs = epochs.astype(np.float64)
+
+    if not len(epochs):
+        return []
+
+    if epochs.dtype.kind in 'iu':
+        seconds = epochs.astype(np.int64)
+    elif not np.isfinite(epochs).all():
+        return _local_time_strings_slow(epochs)
+    else:
+        # Round to microseconds like fromtimestamp, which may carry a second
+        frac, seconds = np.modf(epochs)
+        microseconds = np.rint(frac * 1e6)
+        seconds = (seconds + (microseconds >= 1e6) -
+                   (microseconds < 0)).astype(np.int64)
+
+    hours, inverse = np.unique(seconds // _HOUR, return_inverse=True)
+    try:
+        start_offsets = np.array([_local_offset(hour * _HOUR)
+                                  for hour in hours.tolist()])
+        end_offsets = np.array([_local_offset(hour * _HOUR + _HOUR - 1)
+                                for hour in hours.tolist()])
+    except (OverflowError, OSError, ValueError):
+        return _local_time_strings_slow(epochs)
+
+    offsets = start_offsets[inverse]
+    for i in np.flatnonzero((start_offsets != end_offsets)[inverse]):
+        offsets[i] = _local_offset(int(seconds[i]))
+
+    local = seconds + offsets
+    if local.min() < _MIN_SECONDS or local.max() > _MAX_SECONDS:
+        return _local_time_strings_slow(epochs)
+
+    strs = np.datetime_as_string(local.astype('datetime64[s]'))
+    strs.view('U1').reshape(len(strs), -1)[:, 10] = ' '
+
+    return strs.tolist()
+
+
+def _local_time_strings_slow(epochs):
+    # Also raises the same errors as fromtimestamp for invalid timestamps
+    return [f"{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S}"
+            for ts in epochs.tolist()]
+
+
+def display_messages(lines) -> list:
+    """
+    Generate the ``sd_answers.display_message`` display strings for JSON
+    Lines messages, given as a string or an iterable of lines. Messages may
+    use any of the ``sd_answers.EPOCH_FIELDS``.
+    """
+    if isinstance(lines, str):
+        lines = lines.split('\n')
+
+    decoded = [json.loads(line) for line in lines if line.strip()]
+    float_epochs = [msg.get("sent_epoch") for msg in decoded]
+    if None not in float_epochs:
+        sent_strs = local_time_strings(float_epochs)
+    else:
+        # Integer epochs only need whole seconds, and so do float epochs
+        # once they are rounded like fromtimestamp
+        sent_strs = local_time_strings(np.array(
+            [sd_answers.get_sent_seconds(msg) if epoch is None
+             else sd_answers._split_timestamp(epoch)[0]
+             for msg, epoch in zip(decoded, float_epochs)],
+            dtype=np.int64))
+
+    return [f"({sent_str}) {msg['user_from']}\n{msg['message']}"
+            for sent_str, msg in zip(sent_strs, decoded)]
+
+
+def read_messages(stream, batch_size=10000):
+    """
+    Read JSON Lines messages from a text stream, yielding lists of up to
+    ``batch_size`` display strings.
+    """
+    while True:
+        lines = list(itertools.islice(stream, batch_size))
+        if not lines:
+            return
+
+        display_strs = display_messages(lines)
+        if display_strs:
+            yield display_strs
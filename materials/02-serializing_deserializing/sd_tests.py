@@ -1,14 +1,22 @@
 import json
 import logging
+import os
+import pickle
 import sd_answers
+import tempfile
+import threading
+import zipfile
 
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from dateutil import tz
+from io import BytesIO, StringIO
 
 from freezegun import freeze_time
 
 from helper_functions import TZEnvContext
 
+from sd_helpers import SANTIAGO, SANTIAGO_2016, SANTIAGO_2016_DATA
+
 
 ### Exercise: Write a function to store a message with metadata in JSON
 def test_encode_message_metadata(encode_message):
@@ -49,6 +57,54 @@ def test_display_message_metadata(display_message):
     print("Passed!")
 
 
+def test_epoch_units(encode_message, display_message):
+    with freeze_time("2019-11-03T01:59:59.999999-04:00"):
+        json_strs = {unit: encode_message("to", "from", "Message",
+                                          epoch_unit=unit)
+                     for unit in ("s", "us", "ns")}
+
+    assert json.loads(json_strs["us"])["sent_epoch_us"] == 1572760799999999
+    assert json.loads(json_strs["ns"])["sent_epoch_ns"] == \
+        1572760799999999000
+
+    with TZEnvContext('America/New_York'):
+        for unit, json_str in json_strs.items():
+            display_str = display_message(json_str)
+            expected = "(2019-11-03 01:59:59) from\nMessage"
+
+            assert display_str == expected, f"{unit}: {display_str!r}"
+
+    print("Passed!")
+
+
+def test_message_batches(encode_messages, display_messages):
+    messages = [("cool_beans1973", "xXx_the_matrix_xXx", "Test messageé"),
+                ("xXx_the_matrix_xXx", "cool_beans1973", "Reply\n\"quoted\"")]
+
+    with freeze_time("2000-01-01T05:15:30.214333-05:00"):
+        expected = [sd_answers.encode_message(*msg) for msg in messages]
+
+    clock = lambda: datetime(2000, 1, 1, 10, 15, 30, 214333,
+                             tzinfo=timezone.utc)
+    json_lines = encode_messages(messages, clock=clock)
+    assert json_lines.splitlines() == expected
+
+    # Around the 2019 end of DST in New York
+    json_lines += "".join(
+        json.dumps({"user_from": "x", "sent_epoch": 1572757200 + ts,
+                    "message": "y"}) + "\n"
+        for ts in (0, 3599.9999996, 3600, 5399.5, 7199, 7200, -0.0000004))
+
+    with TZEnvContext('America/New_York'):
+        act = display_messages(json_lines)
+        exp = [sd_answers.display_message(line)
+               for line in json_lines.splitlines()]
+
+    assert act == exp, f"{act} != {exp}"
+
+    print("Passed!")
+
+
 ### Exercise: Write a function to parse log messages
 def test_parse_log_line(parse_log_line):
     offset = timezone(timedelta(hours=-4))
@@ -94,6 +150,342 @@ def test_parse_log_line(parse_log_line):
     print("Passed!")
 
 
+def test_iter_log_batches(iter_log_batches):
+    lines = [
+        "2019-04-18T18:46:37.211352-04:00 : DEBUG : __main__iso : Message 1",
+        "2019-04-18T18:46:38.000001-04:00 : INFO : __main__iso : Message é",
+        "2019-10-09T03:12:57.113347-04:00 : WARNING : other : \x1cWarning",
+    ] * 50
+    data = ("\n".join(lines[:75]) + "\r\n" +
+            "\n".join(lines[75:]) + "\n\n").encode('utf-8')
+
+    parsers = (sd_answers.parse_log_line, sd_answers.parse_log_line_enum)
+    for parser in parsers:
+        expected = [parser(line) for line in lines]
+        for batch_size, chunk_size in [(1, 1), (7, 100), (1000, 10 ** 6)]:
+            batches = list(iter_log_batches(BytesIO(data),
+                                            batch_size=batch_size,
+                                            chunk_size=chunk_size,
+                                            parser=parser))
+
+            assert all(len(batch) == batch_size for batch in batches[:-1])
+            assert [rec for batch in batches for rec in batch] == expected
+
+    # The whole stream is parsed, even if it has already been read from
+    stream = BytesIO(data)
+    stream.read()
+    batches = iter_log_batches(stream, chunk_size=100, processes=2,
+                               parser=parser)
+    assert [rec for batch in batches for rec in batch] == expected
+
+    print("Passed!")
+
+
+def test_iso_timestamp_parser(parser):
+    nyc = tz.gettz("America/New_York")
+    base = datetime(2019, 11, 3, 1, 59, 59, tzinfo=nyc)
+    dt_strs = [(base + timedelta(microseconds=us)).isoformat()
+               for us in (0, 1, 999999)]
+    dt_strs += [(base + timedelta(hours=1)).isoformat(),
+                "2019-11-03T01:30:00.500000-04:00",
+                "2019-11-03T01:30:00.500000+05:30",
+                "2019-11-03 01:30:00-05:00",
+                "2019-11-03T01:30:00.500-05:00",
+                "2019-11-03T01:30:00"]
+
+    for dt_str in dt_strs:
+        act, exp = parser(dt_str), datetime.fromisoformat(dt_str)
+        assert act == exp and act.utcoffset() == exp.utcoffset(), dt_str
+
+    # Timestamps with the same offset share one tzinfo
+    assert parser(dt_strs[0]).tzinfo is parser(dt_strs[4]).tzinfo
+
+    stats = parser.stats()
+    assert stats.hits and stats.misses and stats.fallbacks, stats
+    assert 0 < stats.hit_rate < 1, stats
+
+    for bad_str in ["2019-11-03T01:61:00-05:00", "2019-11-03T01:30:00-05:0x"]:
+        try:
+            parser(bad_str)
+        except ValueError:
+            pass
+        else:
+            assert False, f"{bad_str} should not parse"
+
+    print("Passed!")
+
+
+def test_parse_log_columns(parse_log_columns):
+    lines = [
+        "2019-11-03T01:59:59.999999-04:00 : DEBUG : __main__iso : Message é",
+        "2019-11-03T01:00:00-05:00 : INFO : other : Message",
+        "2019-11-03T01:30:00.500-05:00 : Level 5 : __main__iso : Odd time",
+        "2019-11-03T06:30:00+00:00 : WARNING : other : : Message",
+    ]
+    data = "\n".join(lines).encode('utf-8')
+
+    cols = parse_log_columns(data)
+    assert len(cols) == len(lines)
+    for i, line in enumerate(lines):
+        act, exp = cols.record(i), sd_answers.parse_log_line_enum(line)
+        assert act == exp, f"{act} != {exp}"
+        assert act['datetime'].utcoffset() == exp['datetime'].utcoffset()
+
+    warnings = cols[cols.level >= logging.INFO]
+    assert len(warnings) == 2
+    assert [warnings.message(i) for i in range(2)] == ["Message",
+                                                       ": Message"]
+    assert len(cols[cols.name_mask("__main__iso")]) == 2
+
+    # A very long field doesn't need a matrix as wide as it for every line
+    long_name = "logger." * 1000
+    lines = lines[:3] + [
+        f"2019-11-03T06:30:00+00:00 : ERROR : {long_name} : Message"]
+    cols = parse_log_columns("\n".join(lines).encode('utf-8'))
+    assert [cols.record(i) for i in range(len(lines))] == [
+        sd_answers.parse_log_line_enum(line) for line in lines]
+    assert len(cols[cols.name_mask(long_name)]) == 1
+
+    # Timestamps need a UTC offset, whether or not they look like the
+    # IsoFormatter layout (the second has 25 characters, as if it did)
+    for dt_str in ["2019-11-03T01:30:00", "2019-11-03T01:30:00.50000"]:
+        try:
+            parse_log_columns(f"{dt_str} : INFO : other : Message".encode())
+        except ValueError:
+            pass
+        else:
+            assert False, f"{dt_str} should not parse"
+
+    print("Passed!")
+
+
+def test_query_time_range(query_time_range):
+    start = datetime(2019, 11, 3, 5, 0, tzinfo=timezone.utc)
+    lines = []
+    for minutes in range(0, 120, 5):
+        dt = start + timedelta(minutes=minutes)
+        local_dt = dt.astimezone(tz.gettz("America/New_York"))
+        lines.append(f"{local_dt.isoformat()} : INFO : __main__iso : "
+                     f"Minute {minutes}")
+        if minutes % 25 == 0:
+            lines += ["Traceback (most recent call last):",
+                      "ValueError: 2019-11-03T01:00:00 : not a record"]
+
+    data = ("\n".join(lines) + "\n").encode('utf-8')
+    queries = [(start + timedelta(minutes=50), start + timedelta(minutes=75)),
+               (start + timedelta(minutes=56), start + timedelta(minutes=75)),
+               (None, start + timedelta(minutes=1)),
+               (start + timedelta(hours=3), None),
+               (None, None)]
+
+    results = []
+    for begin, end in queries:
+        expected, keep = [], False
+        for line in lines:
+            if not line.startswith("Traceback") and \
+                    not line.startswith("ValueError"):
+                dt = datetime.fromisoformat(line.split(" : ")[0])
+                keep = ((begin is None or dt >= begin) and
+                        (end is None or dt < end))
+
+            if keep:
+                expected.append(line)
+
+        act = query_time_range(BytesIO(data), begin, end)
+        assert act == expected, f"{begin} - {end}: {act}"
+        results.append(expected)
+
+    # With an index beside the file, which is rebuilt when the file is
+    # replaced by another of the same size, and otherwise reused
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "iso.log")
+        with open(path, 'wb') as f:
+            f.write(data.replace(b"2019-11-03", b"2019-11-04"))
+
+        query_time_range(path, *queries[0], use_index=True)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        for use in ("stale", "fresh"):
+            mtime = os.stat(path + '.tidx').st_mtime_ns
+            for (begin, end), expected in zip(queries, results):
+                act = query_time_range(path, begin, end, use_index=True)
+                assert act == expected, f"{use} index, {begin} - {end}"
+
+            assert (os.stat(path + '.tidx').st_mtime_ns == mtime) == \
+                (use == "fresh"), f"{use} index"
+
+        # Without anywhere to save the index, it is still used. (Root can
+        # write to read-only directories, so the sidecar is also blocked.)
+        os.remove(path + '.tidx')
+        os.mkdir(path + '.tidx')
+        os.chmod(tmpdir, 0o555)
+        try:
+            for (begin, end), expected in zip(queries, results):
+                act = query_time_range(path, begin, end, use_index=True)
+                assert act == expected, f"unsaved index, {begin} - {end}"
+        finally:
+            os.chmod(tmpdir, 0o755)
+
+    print("Passed!")
+
+
+def test_iso_formatter(IsoFormatter):
+    record = logging.makeLogRecord({})
+
+    # Around the 2019 end of DST in New York, in the local zone and in UTC
+    timestamps = [1572757200 + seconds + frac
+                  for seconds in range(0, 7200 * 2, 599)
+                  for frac in (0, 0.5, 0.0000004, 0.9999996, 0.123456)]
+
+    with TZEnvContext('America/New_York'):
+        for tzi in (tz.tzlocal(), tz.UTC):
+            formatter = IsoFormatter(tzinfo=tzi)
+            for ts in timestamps:
+                record.created = ts
+                exp = datetime.fromtimestamp(ts, tz=tzi).isoformat()
+                act = formatter.formatTime(record)
+
+                assert act == exp, f"{act} != {exp}"
+
+    print("Passed!")
+
+
+def test_queue_logger(get_iso_logger):
+    for overflow in ("block", "drop_oldest", "drop_newest"):
+        logger = get_iso_logger(f"test_queue_logger.{overflow}",
+                                use_queue=True, queue_size=10,
+                                overflow=overflow)
+        handler = logger.handlers[-1]
+        stream = StringIO()
+        handler.listener.handlers[0].setStream(stream)
+
+        # Getting the logger again reuses its handler and listener
+        n_threads = threading.active_count()
+        assert get_iso_logger(f"test_queue_logger.{overflow}",
+                              use_queue=True).handlers == [handler]
+        assert threading.active_count() == n_threads
+
+        for i in range(1000):
+            logger.info("Message %d", i)
+
+        handler.queue.join()
+        lines = stream.getvalue().splitlines()
+
+        assert handler.queued + handler.dropped == 1000
+        assert len(lines) == handler.queued
+        assert lines[-1].endswith(" : INFO : "
+                                  f"test_queue_logger.{overflow} : "
+                                  "Message 999") or overflow == "drop_newest"
+
+        handler.listener.stop()
+        logger.removeHandler(handler)
+
+    # Switching between a plain and a queued handler replaces the handler,
+    # so each line is still written once
+    name = "test_queue_logger.switch"
+    get_iso_logger(name)
+    logger = get_iso_logger(name, use_queue=True)
+    assert len(logger.handlers) == 1 and hasattr(logger.handlers[0],
+                                                 'listener')
+
+    n_threads = threading.active_count()
+    logger = get_iso_logger(name)
+    assert len(logger.handlers) == 1 and not hasattr(logger.handlers[0],
+                                                     'listener')
+    assert threading.active_count() == n_threads - 1
+
+    logger.removeHandler(logger.handlers[0])
+
+    print("Passed!")
+
+
+def test_tzif_data(TZifData):
+    tzif = TZifData(SANTIAGO_2016_DATA, filename="America/Santiago")
+    expected = tz.tzfile(BytesIO(SANTIAGO_2016_DATA),
+                         filename="America/Santiago")
+
+    tzi1, tzi2 = tzif.tzinfo(), tzif.tzinfo()
+    assert tzi1 == expected and tzi1._trans_list is tzi2._trans_list
+    assert tzif.trans_list_utc.tolist() == list(expected._trans_list_utc)
+
+    start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+    for hours in range(0, 24 * 365 * 4, 7):
+        dt = start + timedelta(hours=hours)
+        act, exp = dt.astimezone(tzi1), dt.astimezone(expected)
+        assert (act.replace(tzinfo=None), act.utcoffset(), act.fold) == \
+            (exp.replace(tzinfo=None), exp.utcoffset(), exp.fold)
+
+    print("Passed!")
+
+
+def test_tzif_store(TZifStore):
+    expected = tz.tzfile(BytesIO(SANTIAGO_2016_DATA),
+                         filename="America/Santiago")
+    start = datetime(2014, 1, 1, tzinfo=timezone.utc)
+    utc_dts = [start + timedelta(hours=hours)
+               for hours in range(0, 24 * 365 * 4, 7)]
+
+    def check_zone(tzi, path):
+        for dt in utc_dts:
+            act, exp = dt.astimezone(tzi), dt.astimezone(expected)
+            assert (act.replace(tzinfo=None), act.utcoffset(), act.fold) == \
+                (exp.replace(tzinfo=None), exp.utcoffset(), exp.fold), path
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        zone_dir = os.path.join(tmpdir, "zoneinfo")
+        os.makedirs(os.path.join(zone_dir, "America"))
+        with open(os.path.join(zone_dir, "America", "Santiago"), 'wb') as f:
+            f.write(SANTIAGO_2016_DATA)
+
+        paths = [zone_dir]
+        for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            paths.append(os.path.join(tmpdir, f"zoneinfo{compression}.zip"))
+            with zipfile.ZipFile(paths[-1], 'w', compression) as zf:
+                zf.writestr("America/Santiago", SANTIAGO_2016_DATA)
+
+        for path in paths:
+            with TZifStore(path) as store:
+                tzi = store.get("America/Santiago")
+                assert store.get("America/Santiago") is tzi, path
+                try:
+                    store.get("America/Nowhere")
+                except KeyError:
+                    pass
+                else:
+                    assert False, f"{path}: America/Nowhere should not load"
+
+            # Zones outlive the store, and pickle as plain tzfiles
+            check_zone(tzi, path)
+            check_zone(pickle.loads(pickle.dumps(tzi)), path)
+
+    print("Passed!")
+
+
+def test_zone_versions(ZoneVersionRegistry):
+    registry = ZoneVersionRegistry()
+    registry.add_zone("America/Santiago", date(2016, 3, 20), SANTIAGO)
+    registry.add_zone("America/Santiago", date.min, SANTIAGO_2016)
+
+    for access_date, expected in [(date(2000, 1, 1), SANTIAGO_2016),
+                                  (datetime(2016, 3, 19, 23), SANTIAGO_2016),
+                                  (datetime(2016, 3, 20), SANTIAGO),
+                                  (date(2020, 1, 1), SANTIAGO)]:
+        tzi = registry.get("America/Santiago", access_date)
+        assert tzi is expected, f"{access_date}: {tzi!r}"
+
+    assert registry.get("America/New_York", date(2000, 1, 1)) is \
+        tz.gettz("America/New_York")
+
+    assert registry.effective_date("America/Santiago",
+                                   date(2020, 1, 1)) == date(2016, 3, 20)
+    assert registry.effective_date("America/New_York",
+                                   date(2000, 1, 1)) is None
+
+    print("Passed!")
+
+
 ### Exercise: Write a JSON encoder and decoder hook for datetimes
 def get_annotated_tz(name):
     """
@@ -117,6 +509,46 @@ dts = [
     datetime(2020, 11, 1, 1, 30, fold=1, tzinfo=NYC)
 ]
 
+def test_decode_hook(decode_datetime_hook):
+    json_str = json.dumps({"sent": dts[0], "meta": {"fold": 0, "tags": []},
+                           "others": dts}, cls=sd_answers.DatetimeEncoder)
+    decoded = json.loads(json_str, object_hook=decode_datetime_hook)
+
+    assert decoded == {"sent": dts[0], "meta": {"fold": 0, "tags": []},
+                       "others": dts}
+
+    # Decoding shouldn't modify the zones shared by all gettz callers
+    paris = tz.gettz("Europe/Paris")
+    json_str = json.dumps(datetime(2020, 10, 25, 2, 30, fold=1,
+                                   tzinfo=get_annotated_tz("Europe/Paris")),
+                          cls=sd_answers.DatetimeEncoder)
+    del paris.name
+
+    dt = json.loads(json_str, object_hook=decode_datetime_hook)
+    assert dt.tzinfo is paris and dt.fold == 1
+    assert not hasattr(paris, 'name')
+
+    # Zones are named by where gettz found them, so a zone that is never
+    # annotated still round trips, and UTC is "UTC" whatever alias was used
+    tokyo = datetime(2020, 1, 1, tzinfo=tz.gettz("Asia/Tokyo"))
+    dt = json.loads(json.dumps(tokyo, cls=sd_answers.DatetimeEncoder),
+                    object_hook=decode_datetime_hook)
+    assert dt.tzinfo is tokyo.tzinfo
+
+    # A zone got with get_named_tz is named as it was got
+    zone = sd_answers.get_named_tz("EST5EDT4,M3.2.0,M11.1.0")
+    dt = datetime(2020, 11, 1, 1, 30, fold=1, tzinfo=zone)
+    dt_rt = json.loads(json.dumps(dt, cls=sd_answers.DatetimeEncoder),
+                       object_hook=decode_datetime_hook)
+    assert dt_rt.tzinfo is zone and dt_rt.fold == 1
+
+    sd_answers.get_named_tz("GMT")
+    json_str = json.dumps(datetime(2020, 1, 1, tzinfo=tz.UTC),
+                          cls=sd_answers.DatetimeEncoder)
+    assert json.loads(json_str)['timezone'] == "UTC"
+
+    print("Passed!")
+
 def print_encodings(encoder):
     for dt in dts:
         print(encoder.encode(dt))
@@ -128,3 +560,29 @@ def test_round_trip(encoder, decoder):
         assert dt_rt.fold == dt.fold
 
     print("Passed!")
+
+def test_binary_round_trip(encode_datetimes, decode_datetimes):
+    for values in (dts, dts[::-1] * 3, [], dts[1:2]):
+        values_rt = decode_datetimes(encode_datetimes(values))
+
+        assert values_rt == values
+        assert [dt.fold for dt in values_rt] == [dt.fold for dt in values]
+        assert ([dt.utcoffset() for dt in values_rt] ==
+                [dt.utcoffset() for dt in values])
+
+    print("Passed!")
+
+def test_iter_json_array(iter_json_array):
+    values = dts + [1, -2.5e10, "é", None, {"nested": [dts[0]]}]
+    json_str = json.dumps(values, cls=sd_answers.DatetimeEncoder, indent=1)
+
+    for stream in (StringIO(json_str), BytesIO(json_str.encode('utf-8'))):
+        for chunk_size in (1, 5, 65536):
+            stream.seek(0)
+            decoded = list(iter_json_array(stream, chunk_size=chunk_size))
+
+            assert decoded == values
+            assert [dt.fold for dt in decoded[:len(dts)]] == \
+                [dt.fold for dt in dts]
+
+    print("Passed!")
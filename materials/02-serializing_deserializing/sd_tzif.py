@@ -0,0 +1,422 @@
+"""
+Memory-mapped loading of compiled TZif time zone files.
+
+Keeping many versions of the time zone data side by side (see
+``sd_helpers.ChileTzInfo``) means loading many zone files. Rather than
+reading each one into memory, ``TZifData`` maps the file and exposes its
+transition arrays as numpy views of the mapping. The ``tz.tzfile`` data is
+only built when a ``tzinfo`` first needs it, and is shared by every
+``tzinfo`` built from the same file.
+
+A ``TZifStore`` gives access to a whole zoneinfo directory, or to a zip
+archive of one; members stored without compression are used in place. A
+``ZoneVersionRegistry`` gives the version of a zone in effect at a date.
+"""
+import bisect
+import io
+import mmap
+import os
+import re
+import struct
+import zipfile
+
+from collections import OrderedDict
+from datetime import date
+
+import dateutil
+from dateutil import tz
+
+import numpy as np
+
+_HEADER = struct.Struct(">4s16x6l")
+_ZIP_LOCAL_HEADER = struct.Struct("<4s22xHH")
+
+_TTINFO_DTYPE = np.dtype([('utoff', '>i4'), ('isdst', 'u1'),
+                          ('abbrind', 'u1')])
+
+FILE_CACHE_SIZE = 128
+
+
+### dateutil internals
+# dateutil has no public way to build a tzfile from data that has already
+# been read, so this uses the private methods tzfile.__init__ itself uses,
+# in the dateutil versions they are known to work in. With other versions
+# each tzfile reads the data again, through the public constructor.
+_SHARED_TZDATA_VERSIONS = ((2, 7), (3, 0))
+_DATEUTIL_VERSION = tuple(
+    int(part) for part in re.findall(r'\d+', dateutil.__version__)[:2])
+
+_SHARED_TZDATA = (
+    _SHARED_TZDATA_VERSIONS[0] <= _DATEUTIL_VERSION <
+    _SHARED_TZDATA_VERSIONS[1] and
+    hasattr(tz.tzfile, '_read_tzfile') and hasattr(tz.tzfile, '_set_tzdata'))
+
+
+def _read_tzdata(buffer):
+    """The data for a ``tz.tzfile``, or None if it can't be shared"""
+    if not _SHARED_TZDATA:
+        return None
+
+    try:
+        # _read_tzfile doesn't use the tzfile it is called on
+        return tz.tzfile._read_tzfile(None, _BufferReader(buffer))
+    except (AttributeError, TypeError) as e:
+        raise RuntimeError(
+            f"The private tz.tzfile methods of dateutil "
+            f"{dateutil.__version__} don't work as sd_tzif expects (as in "
+            f"dateutil 2.7 to 2.9)") from e
+
+
+def _init_tzfile(tzi, tzif):
+    """Initialize the ``tz.tzfile`` ``tzi`` with the data in ``tzif``"""
+    tzdata = tzif.get_tzdata()
+    if tzdata is None:
+        tz.tzfile.__init__(tzi, io.BytesIO(tzif.buffer.tobytes()),
+                           filename=tzif.filename)
+    else:
+        tz.tzfile.__init__(tzi, None, filename=tzif.filename)
+        tzi._set_tzdata(tzdata)
+
+
+def map_file(path):
+    """Memory-map a file read-only, or read it if it is empty"""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b''
+
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class TZifData:
+    """
+    The data in a compiled TZif file, given as any buffer (e.g. a mapped
+    file), without copying it.
+
+    As with ``tz.tzfile``, only the version 1 data is used. Once the
+    ``tz.tzfile`` data has been built, that (small) part of a mapped buffer
+    is copied and the buffer released (see ``close``).
+    """
+    def __init__(self, buffer, filename=None):
+        self.buffer = memoryview(buffer)
+        self.filename = filename
+        self._mmap = buffer if isinstance(buffer, mmap.mmap) else None
+
+        try:
+            (magic, self._isutcnt, self._isstdcnt, self._leapcnt,
+             self._timecnt, self._typecnt,
+             self._charcnt) = _HEADER.unpack_from(self.buffer)
+        except struct.error:
+            magic = None
+
+        if magic != b"TZif":
+            raise ValueError(f"Not a TZif file: {filename!r}")
+
+        self._trans_offset = _HEADER.size
+        self._idx_offset = self._trans_offset + 4 * self._timecnt
+        self._ttinfo_offset = self._idx_offset + self._timecnt
+        self._abbr_offset = self._ttinfo_offset + 6 * self._typecnt
+
+        self._end = (self._abbr_offset + self._charcnt + 8 * self._leapcnt +
+                     self._isstdcnt + self._isutcnt)
+        if len(self.buffer) < self._end:
+            raise ValueError(f"Truncated TZif file: {filename!r}")
+
+        self._tzdata = None
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(map_file(path), filename=os.fspath(path))
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.filename!r}>"
+
+    @property
+    def trans_list_utc(self):
+        """Transition times, in seconds since the epoch"""
+        return np.frombuffer(self.buffer, dtype='>i4', count=self._timecnt,
+                             offset=self._trans_offset)
+
+    @property
+    def trans_idx(self):
+        """The index in ``ttinfo`` of the type after each transition"""
+        return np.frombuffer(self.buffer, dtype='u1', count=self._timecnt,
+                             offset=self._idx_offset)
+
+    @property
+    def ttinfo(self):
+        """The local time types: UTC offset, DST flag, abbreviation index"""
+        return np.frombuffer(self.buffer, dtype=_TTINFO_DTYPE,
+                             count=self._typecnt, offset=self._ttinfo_offset)
+
+    def get_tzdata(self):
+        """The data for a ``tz.tzfile``, built the first time it is needed"""
+        if self._tzdata is None:
+            self._tzdata = _read_tzdata(self.buffer)
+            self.close()
+
+        return self._tzdata
+
+    def close(self):
+        """
+        Copy the version 1 data out of a mapped buffer (a file, or part of
+        an archive), and release the buffer, unmapping a mapped file
+        """
+        if isinstance(self.buffer.obj, bytes):
+            return
+
+        mapped, self.buffer = self.buffer, memoryview(
+            self.buffer[:self._end].tobytes())
+        try:
+            mapped.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            # Arrays from the properties still use the mapping, which is
+            # closed once they are freed
+            pass
+
+        self._mmap = None
+
+    def tzinfo(self):
+        """A new ``tzinfo`` sharing this file's data"""
+        return MappedTzFile(self)
+
+
+class _BufferReader:
+    """The file methods ``tz.tzfile`` uses to read, over a buffer"""
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.pos = 0
+
+    def read(self, size):
+        data = self.buffer[self.pos:self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+
+        self.pos = offset
+        return self.pos
+
+
+class MappedTzFile(tz.tzfile):
+    """
+    A ``tz.tzfile`` built from the shared data of a ``TZifData``.
+
+    Copies and pickles are plain ``tz.tzfile``\\s with the same data, which
+    behave the same way: the ``TZifData`` (which may map a file, or a member
+    of an archive that is no longer open) can't be pickled, and nothing
+    but sharing depends on it.
+    """
+    def __init__(self, tzif):
+        _init_tzfile(self, tzif)
+        self._tzif = tzif
+
+    def __reduce_ex__(self, protocol):
+        state = dict(self.__dict__)
+        del state['_tzif']
+        return (tz.tzfile, (None, self._filename), state)
+
+
+_FILE_CACHE = OrderedDict()
+
+
+def load_tzif(path):
+    """
+    Get the ``TZifData`` for a file, which is only read again if the file
+    changes. The last ``FILE_CACHE_SIZE`` files loaded are cached.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    tzif = _FILE_CACHE.get(key)
+    if tzif is None:
+        tzif = _FILE_CACHE[key] = TZifData.from_file(path)
+        while len(_FILE_CACHE) > FILE_CACHE_SIZE:
+            _FILE_CACHE.popitem(last=False)
+    else:
+        _FILE_CACHE.move_to_end(key)
+
+    return tzif
+
+
+class TZifStore:
+    """
+    Zones from a zoneinfo directory (e.g. one version of the time zone
+    database), or from a zip archive of one.
+
+    ``get(name)`` returns the same ``tzinfo`` for each call with a name,
+    like ``tz.gettz``. An archive stays mapped until the store is closed
+    (e.g. with ``with``); zones already got from the store still work
+    afterwards.
+    """
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self._zones = {}
+        self._tzifs = {}
+        self._closed = False
+        if os.path.isdir(self.path):
+            self._archive = None
+        else:
+            self._archive = map_file(self.path)
+            with zipfile.ZipFile(self.path) as zf:
+                self._members = {info.filename: info
+                                 for info in zf.infolist()}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop using the archive, unmapping it"""
+        self._closed = True
+        if self._archive is None:
+            return
+
+        for tzif in self._tzifs.values():
+            tzif.close()
+
+        try:
+            self._archive.close()
+        except BufferError:
+            # Arrays from TZifData properties still use the mapping, which
+            # is closed once they are freed
+            pass
+
+        self._archive = None
+
+    def get_tzif(self, name):
+        """The ``TZifData`` for a zone name"""
+        if self._closed:
+            raise ValueError(f"{self!r} is closed")
+
+        if self._archive is None:
+            path = os.path.join(self.path, *name.split('/'))
+            if not os.path.isfile(path):
+                raise KeyError(name)
+
+            return load_tzif(path)
+
+        tzif = self._tzifs.get(name)
+        if tzif is None:
+            tzif = self._tzifs[name] = TZifData(
+                self._member_data(self._members[name]), filename=name)
+
+        return tzif
+
+    def _member_data(self, info):
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.path) as zf:
+                return zf.read(info)
+
+        # The member data follows its local header in the archive
+        signature, name_len, extra_len = _ZIP_LOCAL_HEADER.unpack_from(
+            self._archive, info.header_offset)
+        if signature != b"PK\x03\x04":
+            raise ValueError(f"Bad zip member: {info.filename!r}")
+
+        start = (info.header_offset + _ZIP_LOCAL_HEADER.size + name_len +
+                 extra_len)
+        return memoryview(self._archive)[start:start + info.file_size]
+
+    def get(self, name):
+        tzi = self._zones.get(name)
+        if tzi is None:
+            tzi = self._zones[name] = self.get_tzif(name).tzinfo()
+
+        return tzi
+
+
+class ZoneVersionRegistry:
+    """
+    Zones as they were known at a given date, e.g. the version of each zone
+    in the time zone database release current at the time a record was
+    written.
+
+    A version is either a single zone (``add_zone``) or a store of every
+    zone in a release (``add_store``), effective from the start of a date.
+    Dates before every version of a zone get ``default(name)``, which is
+    by default the current version from ``tz.gettz``.
+
+    Lookups are cached by zone and by the versions in effect, so every
+    access date that sees the same version gets the same shared ``tzinfo``,
+    and the cache only grows with the zones and versions looked up.
+    """
+    def __init__(self, default=tz.gettz):
+        self._default = default
+        self._zones = {}        # name -> ([effective ordinal], [tzinfo])
+        self._stores = ([], [])
+        self._cache = {}        # (name, zone i, store j) -> (ordinal, tzi)
+
+    def add_zone(self, name, effective_date, tzi):
+        self._insert(self._zones.setdefault(name, ([], [])),
+                     effective_date, tzi)
+
+    def add_store(self, effective_date, store):
+        self._insert(self._stores, effective_date, store)
+
+    def _insert(self, versions, effective_date, value):
+        ordinals, values = versions
+        i = bisect.bisect_right(ordinals, effective_date.toordinal())
+        ordinals.insert(i, effective_date.toordinal())
+        values.insert(i, value)
+        self._cache.clear()
+
+    def get(self, name, access_date):
+        """The shared ``tzinfo`` for ``name`` as of ``access_date``"""
+        return self._lookup(name, access_date)[1]
+
+    def effective_date(self, name, access_date):
+        """
+        The date the version of ``name`` in effect at ``access_date`` took
+        effect, or None for the ``default``
+        """
+        ordinal = self._lookup(name, access_date)[0]
+        return None if ordinal is None else date.fromordinal(ordinal)
+
+    def _lookup(self, name, access_date):
+        # Every access date between the same version boundaries finds the
+        # same version, so cache by those rather than by date
+        ordinal = access_date.toordinal()
+        i = bisect.bisect_right(self._zones.get(name, ([], []))[0], ordinal)
+        j = bisect.bisect_right(self._stores[0], ordinal)
+
+        key = (name, i, j)
+        found = self._cache.get(key)
+        if found is None:
+            found = self._cache[key] = self._find(name, i, j)
+
+        return found
+
+    def _find(self, name, i, j):
+        # The latest zone version, then the latest store with the zone
+        ordinals, zones = self._zones.get(name, ([], []))
+        zone_ordinal = ordinals[i - 1] if i else None
+
+        store_ordinals, stores = self._stores
+        for j in range(j, 0, -1):
+            if zone_ordinal is not None and store_ordinals[j - 1] < \
+                    zone_ordinal:
+                break
+
+            try:
+                return store_ordinals[j - 1], stores[j - 1].get(name)
+            except KeyError:
+                pass
+
+        if zone_ordinal is not None:
+            return zone_ordinal, zones[i - 1]
+
+        tzi = self._default(name)
+        if tzi is None:
+            raise ValueError(f"Unknown time zone: {name}")
+
+        return None, tzi
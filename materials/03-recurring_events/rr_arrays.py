@@ -0,0 +1,294 @@
+"""
+Bulk expansion of recurrence rules into NumPy ``datetime64`` arrays, rather
+than one ``datetime`` at a time through ``rrule``'s iterator.
+
+Rules in the common subset used in ``rr_answers`` (fixed times of day, with
+days chosen by month, day of the month, weekday or nth weekday, e.g.
+``get_weekday_schedule`` or ``MLK_DAY``) are expanded with array
+operations. Anything else falls back to ``rrule.between``.
+
+``expand_rules`` expands many rules at once in a pool of processes.
+"""
+import functools
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from dateutil.rrule import YEARLY, MONTHLY, WEEKLY, DAILY
+from dateutil.rrule import rrule, rruleset, rrulestr
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+_US_PER_DAY = 86400 * 1000000
+
+# rrule stops at the end of year 9999
+_MAX_DAY = np.datetime64('10000-01-01', 'D').astype(np.int64)
+_CHUNK_DAYS = 4096
+
+
+def _to_us(dt):
+    return (dt - _EPOCH) // _ONE_US
+
+
+def can_vectorize(rule):
+    """Whether ``between_array`` expands ``rule`` without its iterator"""
+    if isinstance(rule, rruleset):
+        return all(map(can_vectorize, rule._rrule + rule._exrule))
+
+    return (isinstance(rule, rrule) and
+            rule._freq in (YEARLY, MONTHLY, WEEKLY, DAILY) and
+            rule._tzinfo is None and
+            rule._bysetpos is None and
+            rule._byweekno is None and
+            rule._byyearday is None and
+            rule._byeaster is None)
+
+
+### Day masks
+def _nweekday_mask(rule, weekday, pos, length):
+    """
+    Days that are one of the rule's nth weekdays, counting within a month
+    or year: ``pos`` is the (1-based) day within it, ``length`` its length.
+    """
+    mask = np.zeros(len(weekday), dtype=bool)
+    for wday, n in rule._bynweekday:
+        if n > 0:
+            nth = (pos - 1) // 7 + 1 == n
+        else:
+            nth = (length - pos) // 7 + 1 == -n
+
+        mask |= (weekday == wday) & nth
+
+    return mask
+
+
+def _period(rule, days, weekday):
+    """The period of each day, counted from dtstart's period"""
+    start = rule._dtstart
+    start_day = _to_us(start) // _US_PER_DAY
+    if rule._freq == DAILY:
+        return days - start_day
+
+    if rule._freq == WEEKLY:
+        week_start = days - (weekday - rule._wkst) % 7
+        start_week = start_day - (start.weekday() - rule._wkst) % 7
+        return (week_start - start_week) // 7
+
+    months = days.astype('datetime64[D]').astype('datetime64[M]')
+    if rule._freq == MONTHLY:
+        return months.astype(np.int64) - ((start.year - 1970) * 12 +
+                                          start.month - 1)
+
+    return months.astype('datetime64[Y]').astype(np.int64) - (start.year -
+                                                               1970)
+
+
+def _select_days(rule, days):
+    """
+    The days (``int64`` days since the epoch) that the rule occurs on. The
+    cheapest filters go first, so later ones only look at the days left.
+    """
+    weekday = (days + 3) % 7       # 1970-01-01 was a Thursday
+    if rule._interval != 1:
+        keep = _period(rule, days, weekday) % rule._interval == 0
+        days, weekday = days[keep], weekday[keep]
+
+    if rule._byweekday:
+        keep = np.isin(weekday, rule._byweekday)
+        days, weekday = days[keep], weekday[keep]
+
+    dates = days.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    if rule._bymonth:
+        month = months.astype(np.int64) % 12 + 1
+        keep = np.isin(month, rule._bymonth)
+        days, weekday = days[keep], weekday[keep]
+        dates, months = dates[keep], months[keep]
+
+    if not (rule._bymonthday or rule._bynmonthday or rule._bynweekday):
+        return days
+
+    month_start = months.astype('datetime64[D]')
+    month_day = (dates - month_start).astype(np.int64) + 1
+    month_len = ((months + 1).astype('datetime64[D]') -
+                 month_start).astype(np.int64)
+
+    keep = np.ones(len(days), dtype=bool)
+    if rule._bymonthday or rule._bynmonthday:
+        keep &= (np.isin(month_day, rule._bymonthday) |
+                 np.isin(month_day - month_len - 1, rule._bynmonthday))
+
+    if rule._bynweekday:
+        # As in rrule, nth weekdays count within the month for MONTHLY
+        # rules or YEARLY rules with a bymonth, and otherwise the year
+        if rule._freq == MONTHLY or rule._bymonth:
+            pos, length = month_day, month_len
+        else:
+            years = months.astype('datetime64[Y]')
+            year_start = years.astype('datetime64[D]')
+            pos = (dates - year_start).astype(np.int64) + 1
+            length = ((years + 1).astype('datetime64[D]') -
+                      year_start).astype(np.int64)
+
+        keep &= _nweekday_mask(rule, weekday, pos, length)
+
+    return days[keep]
+
+
+### Expansion
+def _expand_rule(rule, lo_us, hi_us):
+    """The rule's occurrences in ``[lo_us, hi_us]``, as ``int64`` us"""
+    if not can_vectorize(rule):
+        tzi = rule._tzinfo
+        lo = (_EPOCH + timedelta(microseconds=int(lo_us))).replace(tzinfo=tzi)
+        hi = (_EPOCH + timedelta(microseconds=int(hi_us))).replace(tzinfo=tzi)
+        values = rule.between(lo, hi, inc=True)
+        return np.array([_to_us(dt.replace(tzinfo=None)) for dt in values],
+                        dtype=np.int64)
+
+    dtstart_us = _to_us(rule._dtstart)
+    if rule._until is not None:
+        hi_us = min(hi_us, _to_us(rule._until))
+
+    times = np.array(sorted((t.hour * 3600 + t.minute * 60 + t.second) *
+                            1000000 for t in rule._timeset), dtype=np.int64)
+
+    # With a count, the occurrences have to be counted from dtstart
+    remaining = rule._count
+    first_us = dtstart_us if remaining is not None else max(lo_us, dtstart_us)
+    first_day = first_us // _US_PER_DAY
+    last_day = min(hi_us // _US_PER_DAY, _MAX_DAY - 1)
+
+    out = []
+    for chunk_start in range(first_day, last_day + 1, _CHUNK_DAYS):
+        days = np.arange(chunk_start, min(chunk_start + _CHUNK_DAYS,
+                                          last_day + 1), dtype=np.int64)
+        days = _select_days(rule, days)
+
+        occurrences = (days[:, None] * _US_PER_DAY + times).ravel()
+        occurrences = occurrences[occurrences >= dtstart_us]
+        if remaining is not None:
+            occurrences = occurrences[:remaining]
+            remaining -= len(occurrences)
+
+        out.append(occurrences[(occurrences >= lo_us) &
+                               (occurrences <= hi_us)])
+        if remaining == 0:
+            break
+
+    if not out:
+        return np.array([], dtype=np.int64)
+
+    return np.concatenate(out)
+
+
+def _dates_us(dts, lo_us, hi_us):
+    us = np.array([_to_us(dt.replace(tzinfo=None)) for dt in dts],
+                  dtype=np.int64)
+    return us[(us >= lo_us) & (us <= hi_us)]
+
+
+def _expand(rule, lo_us, hi_us):
+    if not isinstance(rule, rruleset):
+        return _expand_rule(rule, lo_us, hi_us)
+
+    included = [_expand_rule(rr, lo_us, hi_us) for rr in rule._rrule]
+    included.append(_dates_us(rule._rdate, lo_us, hi_us))
+
+    excluded = [_expand_rule(rr, lo_us, hi_us) for rr in rule._exrule]
+    excluded.append(_dates_us(rule._exdate, lo_us, hi_us))
+
+    values = np.setdiff1d(np.concatenate(included), np.concatenate(excluded))
+
+    # Ranges excluded from an rr_helpers.Schedule
+    for start, end in getattr(rule, '_exranges', ()):
+        start, end = np.searchsorted(values, [
+            _to_us(start.replace(tzinfo=None)),
+            _to_us(end.replace(tzinfo=None))])
+        values = np.delete(values, np.s_[start:end])
+
+    return values
+
+
+def _bounds(after, before, inc):
+    """The ``between`` limits as inclusive bounds in us"""
+    lo_us, hi_us = _to_us(after.replace(tzinfo=None)), _to_us(
+        before.replace(tzinfo=None))
+    if not inc:
+        lo_us, hi_us = lo_us + 1, hi_us - 1
+
+    return lo_us, hi_us
+
+
+def between_array(rule, after, before, inc=False):
+    """
+    ``rule.between(after, before, inc)`` for an ``rrule`` or ``rruleset``,
+    as a ``datetime64[us]`` array.
+
+    Rules with a ``tzinfo`` are expanded by their iterator, and their
+    occurrences given as local (wall) times.
+    """
+    lo_us, hi_us = _bounds(after, before, inc)
+    if hi_us < lo_us:
+        return np.array([], dtype='datetime64[us]')
+
+    return _expand(rule, lo_us, hi_us).astype('datetime64[us]')
+
+
+### Batch expansion
+@functools.lru_cache(maxsize=1024)
+def _parse_rule(rule_str):
+    return rrulestr(rule_str)
+
+
+def _expand_task(task):
+    rule, lo_us, hi_us = task
+    if isinstance(rule, str):
+        rule = _parse_rule(rule)
+
+    return _expand(rule, lo_us, hi_us)
+
+
+def expand_rules(rules, after, before, inc=False, processes=None,
+                 window=None):
+    """
+    ``between_array(rule, after, before, inc)`` for each of many rules,
+    given as ``rrule`` or ``rruleset`` objects or as RFC 5545 strings (as
+    for ``rrulestr``), expanded in a pool of ``processes`` processes (by
+    default one per CPU).
+
+    If ``window`` (a ``timedelta``) is given, each rule's range is also
+    split into windows of that length, to spread a few long rules over the
+    pool. The arrays are in the same order as ``rules``, and are the same
+    as expanding each rule in turn.
+
+    Rule objects are pickled to the pool, so they can't use ``cache=True``.
+    """
+    if window is not None and window <= timedelta(0):
+        raise ValueError(f"window must be positive, got {window!r}")
+
+    rules = list(rules)
+    lo_us, hi_us = _bounds(after, before, inc)
+    if hi_us < lo_us:
+        return [np.array([], dtype='datetime64[us]') for _ in rules]
+
+    step = hi_us - lo_us + 1 if window is None else window // _ONE_US
+    windows = [(start, min(start + step - 1, hi_us))
+               for start in range(lo_us, hi_us + 1, step)]
+    tasks = [(rule, start, end) for rule in rules for start, end in windows]
+
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or len(tasks) <= 1:
+        results = list(map(_expand_task, tasks))
+    else:
+        chunksize = max(1, len(tasks) // (4 * processes))
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_expand_task, tasks,
+                                    chunksize=chunksize))
+
+    n = len(windows)
+    return [np.concatenate(results[i:i + n]).astype('datetime64[us]')
+            for i in range(0, len(results), n)]
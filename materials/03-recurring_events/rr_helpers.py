@@ -0,0 +1,498 @@
+"""
+Supporting code for working with the schedules in ``rr_answers``.
+
+The main piece is :class:`CachedRuleSet`, which remembers the occurrences of
+an ``rruleset`` as it expands them, so that repeated or overlapping
+``between``, ``after`` and ``before`` queries don't each expand the
+recurrence again from ``dtstart``. :class:`Schedule` is an ``rruleset`` that
+takes dates to add or cancel in bulk, and :class:`DepartureIndex` answers
+"next departures" queries over many schedules at once.
+"""
+import heapq
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from dateutil.rrule import rruleset
+
+from rr_arrays import between_array
+
+_ONE_US = timedelta(microseconds=1)
+
+# Segment bounds: -infinity, a datetime, +infinity. Tuples, so that they
+# compare correctly with each other
+_NEG_INF = (0,)
+_POS_INF = (2,)
+
+
+def _key(dt):
+    return (1, dt)
+
+
+class _Segment:
+    """Every occurrence of a rule set in the interval ``[lo, hi)``"""
+    __slots__ = ('lo', 'hi', 'values')
+
+    def __init__(self, lo, hi, values):
+        self.lo = lo
+        self.hi = hi
+        self.values = values
+
+
+def _cost(seg):
+    """How much of the cache's budget a segment takes"""
+    return len(seg.values) or 1
+
+
+class CachedRuleSet:
+    """
+    A wrapper around an ``rruleset`` (or ``rrule``) that caches the
+    occurrences it has expanded as sorted, non-overlapping segments.
+
+    Queries are answered from the cache where they can be, and only the
+    parts of a range that aren't cached yet are expanded. The least recently
+    used segments are dropped when more than ``max_occurrences`` are cached,
+    though the segment used by the latest query is always kept. A segment
+    with no occurrences (a gap between them) counts as one, so that queries
+    over empty ranges are bounded too.
+
+    The wrapped rule set must not be changed other than through this
+    wrapper's ``rrule``, ``rdate``, ``exrule`` and ``exdate``, which clear
+    the cache.
+    """
+    def __init__(self, rset, max_occurrences=1000000):
+        self._rset = rset
+        self._max_occurrences = max_occurrences
+        self._segments = []     # Sorted by lo
+        self._los = []
+        self._lru = OrderedDict()
+        self._size = 0
+        self._cost = 0          # Occurrences, counting empty segments as 1
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}({self._rset!r}, "
+                f"max_occurrences={self._max_occurrences})")
+
+    def clear(self):
+        self._segments.clear()
+        self._los.clear()
+        self._lru.clear()
+        self._size = 0
+        self._cost = 0
+
+    @property
+    def cached_occurrences(self):
+        return self._size
+
+    @property
+    def cached_segments(self):
+        return len(self._segments)
+
+    ### Changing the rule set
+    def rrule(self, rrule):
+        self._rset.rrule(rrule)
+        self.clear()
+
+    def rdate(self, rdate):
+        self._rset.rdate(rdate)
+        self.clear()
+
+    def exrule(self, exrule):
+        self._rset.exrule(exrule)
+        self.clear()
+
+    def exdate(self, exdate):
+        self._rset.exdate(exdate)
+        self.clear()
+
+    ### Queries
+    def between(self, after, before, inc=False):
+        """As ``rruleset.between``"""
+        if before < after:
+            return []
+
+        values = self._cover(_key(after), _key(before + _ONE_US)).values
+        if inc:
+            start, end = bisect_left(values, after), bisect_right(values,
+                                                                  before)
+        else:
+            start, end = bisect_right(values, after), bisect_left(values,
+                                                                  before)
+
+        return values[start:end]
+
+    def after(self, dt, inc=False):
+        """As ``rruleset.after``"""
+        if not inc:
+            dt = dt + _ONE_US
+
+        pos = _key(dt)
+        while True:
+            i = self._find(pos)
+            if i < len(self._segments) and self._segments[i].lo <= pos:
+                seg = self._segments[i]
+                self._touch(seg)
+                j = bisect_left(seg.values, dt)
+                if j < len(seg.values):
+                    return seg.values[j]
+
+                if seg.hi == _POS_INF:
+                    return None
+
+                pos, dt = seg.hi, seg.hi[1]
+                continue
+
+            # Ask the rule set about the gap up to the next segment
+            gap_end = (self._segments[i].lo if i < len(self._segments)
+                       else _POS_INF)
+            found = self._rset.after(dt, inc=True)
+            if found is not None and _key(found) < gap_end:
+                self._insert(_Segment(pos, _key(found + _ONE_US), [found]))
+                return found
+
+            self._insert(_Segment(pos, gap_end, []))
+            if gap_end == _POS_INF:
+                return None
+
+            pos, dt = gap_end, gap_end[1]
+
+    def before(self, dt, inc=False):
+        """As ``rruleset.before``"""
+        if inc:
+            dt = dt + _ONE_US
+
+        end = _key(dt)
+        while True:
+            # The last segment starting before end
+            i = bisect_left(self._los, end) - 1
+            if i >= 0 and self._segments[i].hi >= end:
+                seg = self._segments[i]
+                self._touch(seg)
+                j = bisect_left(seg.values, dt)
+                if j:
+                    return seg.values[j - 1]
+
+                if seg.lo == _NEG_INF:
+                    return None
+
+                end, dt = seg.lo, seg.lo[1]
+                continue
+
+            # Ask the rule set about the gap back to the previous segment
+            gap_start = self._segments[i].hi if i >= 0 else _NEG_INF
+            found = self._rset.before(dt)
+            if found is not None and _key(found) >= gap_start:
+                self._insert(_Segment(_key(found), end, [found]))
+                return found
+
+            self._insert(_Segment(gap_start, end, []))
+            if gap_start == _NEG_INF:
+                return None
+
+            end, dt = gap_start, gap_start[1]
+
+    ### Cache management
+    def _find(self, pos):
+        """The index of the segment containing ``pos``, or the next one"""
+        i = bisect_right(self._los, pos) - 1
+        if i >= 0 and pos < self._segments[i].hi:
+            return i
+
+        return i + 1
+
+    def _expand(self, lo, hi):
+        after, before = lo[1], hi[1]
+        values = self._rset.between(after, before, inc=True)
+        if values and values[-1] == before:
+            values.pop()
+
+        return values
+
+    def _cover(self, lo, hi):
+        """Get one segment covering ``[lo, hi)``, expanding any gaps"""
+        start = i = self._find(lo)
+        pieces = []
+        pos = lo
+        while pos < hi:
+            if i < len(self._segments) and self._segments[i].lo <= pos:
+                pieces.append(self._segments[i])
+                pos = self._segments[i].hi
+                i += 1
+            else:
+                gap_end = hi
+                if i < len(self._segments):
+                    gap_end = min(hi, self._segments[i].lo)
+
+                pieces.append(_Segment(pos, gap_end,
+                                       self._expand(pos, gap_end)))
+                pos = gap_end
+
+        if len(pieces) == 1 and start < len(self._segments) and \
+                pieces[0] is self._segments[start]:
+            self._touch(pieces[0])
+            return pieces[0]
+
+        values = [value for piece in pieces for value in piece.values]
+        merged = _Segment(min(lo, pieces[0].lo), pos, values)
+        self._replace(start, i, merged)
+
+        return merged
+
+    def _insert(self, seg):
+        """Add a segment that doesn't overlap any others"""
+        i = bisect_right(self._los, seg.lo)
+        self._replace(i, i, seg)
+
+    def _replace(self, start, end, seg):
+        for old in self._segments[start:end]:
+            del self._lru[old]
+            self._size -= len(old.values)
+            self._cost -= _cost(old)
+
+        self._segments[start:end] = [seg]
+        self._los[start:end] = [seg.lo]
+        self._lru[seg] = None
+        self._size += len(seg.values)
+        self._cost += _cost(seg)
+        self._evict(seg)
+
+    def _touch(self, seg):
+        self._lru.move_to_end(seg)
+
+    def _evict(self, keep):
+        while self._cost > self._max_occurrences and len(self._lru) > 1:
+            seg = next(iter(self._lru))
+            if seg is keep:
+                self._lru.move_to_end(seg)
+                seg = next(iter(self._lru))
+
+            del self._lru[seg]
+            i = self._segments.index(seg)
+            del self._segments[i]
+            del self._los[i]
+            self._size -= len(seg.values)
+            self._cost -= _cost(seg)
+
+
+### Bulk rdates and exdates
+def _as_datetimes(dts):
+    """Datetimes from an iterable of datetimes or a datetime64 array"""
+    if isinstance(dts, np.ndarray):
+        return dts.astype('datetime64[us]').tolist()
+
+    return list(dts)
+
+
+class Schedule(rruleset):
+    """
+    An ``rruleset`` that can include and exclude many dates at once, and
+    cancel whole ranges of time.
+
+    Excluded dates are kept in a set and excluded ranges in a sorted list,
+    so unlike ``rruleset``, which merges its exdates into every iteration,
+    each occurrence is checked in constant time however many there are.
+    As with exdates, excluded ranges also exclude rdates.
+    """
+    def __init__(self, cache=False):
+        super().__init__(cache)
+        self._exdate_set = set()
+        self._exranges = []     # Sorted, non-overlapping [start, end)
+
+    @classmethod
+    def from_ruleset(cls, rset):
+        """A ``Schedule`` with the same rules and dates as ``rset``"""
+        schedule = cls()
+        for rule in rset._rrule:
+            schedule.rrule(rule)
+
+        for rule in rset._exrule:
+            schedule.exrule(rule)
+
+        schedule.rdates(rset._rdate)
+        schedule.exdates(rset._exdate)
+        schedule.exclude_ranges(getattr(rset, '_exranges', ()))
+
+        return schedule
+
+    def rdates(self, rdates):
+        """Include datetimes from an iterable or ``datetime64`` array"""
+        self._rdate.extend(_as_datetimes(rdates))
+        self._invalidate_cache()
+
+    def exdate(self, exdate):
+        self.exdates([exdate])
+
+    def exdates(self, exdates):
+        """Exclude datetimes from an iterable or ``datetime64`` array"""
+        exdates = _as_datetimes(exdates)
+        self._exdate.extend(exdates)
+        self._exdate_set.update(exdates)
+        self._invalidate_cache()
+
+    def exclude_range(self, start, end):
+        """Exclude every occurrence in ``[start, end)``"""
+        self.exclude_ranges([(start, end)])
+
+    def exclude_ranges(self, ranges):
+        """Exclude every occurrence in each ``(start, end)`` range"""
+        ranges = sorted(self._exranges + [(start, end)
+                                          for start, end in ranges
+                                          if start < end])
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+
+        self._exranges = merged
+        self._invalidate_cache()
+
+    def exclude_days(self, days, tzinfo=None):
+        """
+        Exclude whole days, given as dates, ``datetime64`` values or ISO
+        strings, e.g. ``schedule.exclude_days(["2020-11-03"])``.
+        """
+        days = np.asarray(days, dtype='datetime64[D]').ravel().tolist()
+        self.exclude_ranges(
+            (datetime.combine(day, datetime.min.time(), tzinfo),
+             datetime.combine(day + timedelta(days=1), datetime.min.time(),
+                              tzinfo))
+            for day in days)
+
+    def _iter(self):
+        self._rdate.sort()
+        occurrences = heapq.merge(self._rdate, *self._rrule)
+        exrules = heapq.merge(*self._exrule)
+        next_exrule = next(exrules, None)
+
+        exdates, exranges = self._exdate_set, self._exranges
+        i = 0
+
+        lastdt = None
+        total = 0
+        for dt in occurrences:
+            if dt == lastdt:
+                continue
+
+            lastdt = dt
+            if dt in exdates:
+                continue
+
+            # Occurrences come in order, so the ranges are only passed once
+            while i < len(exranges) and exranges[i][1] <= dt:
+                i += 1
+
+            if i < len(exranges) and exranges[i][0] <= dt:
+                continue
+
+            while next_exrule is not None and next_exrule < dt:
+                next_exrule = next(exrules, None)
+
+            if next_exrule is not None and next_exrule == dt:
+                continue
+
+            total += 1
+            yield dt
+
+        self._len = total
+
+
+### Departure index
+def _as_datetime64(dt):
+    return np.datetime64(dt.replace(tzinfo=None), 'us')
+
+
+class DepartureIndex:
+    """
+    The departures of many routes (``rrule`` or ``rruleset`` schedules,
+    by name) within the horizon ``[start, end]``, expanded once into sorted
+    ``datetime64[us]`` arrays.
+
+    Each route query is a binary search of that route's array. Changing a
+    route with ``update`` or ``remove`` only expands that route again.
+    Departures after ``end`` are not in the index, and, as with
+    ``rr_arrays.between_array``, rules with a ``tzinfo`` give local times.
+    """
+    def __init__(self, routes, start, end):
+        self.start = start
+        self.end = end
+        self._departures = {}
+        for name, rule in dict(routes).items():
+            self.update(name, rule)
+
+    def __repr__(self):
+        return (f"<{self.__class__.__name__}: {len(self)} routes, "
+                f"{self.start} - {self.end}>")
+
+    def __len__(self):
+        return len(self._departures)
+
+    def __contains__(self, name):
+        return name in self._departures
+
+    @property
+    def routes(self):
+        return list(self._departures)
+
+    def update(self, name, rule):
+        """Add a route, or replace its schedule"""
+        self._departures[name] = between_array(rule, self.start, self.end,
+                                               inc=True)
+
+    def remove(self, name):
+        del self._departures[name]
+
+    def departures(self, name):
+        """Every departure on a route in the horizon"""
+        return self._departures[name]
+
+    ### Per-route queries
+    def next_departures(self, name, dt, n=1, inc=False):
+        """The next ``n`` departures on a route after ``dt``"""
+        departures = self._departures[name]
+        i = departures.searchsorted(_as_datetime64(dt),
+                                    side='left' if inc else 'right')
+        return departures[i:i + n]
+
+    def between(self, name, after, before, inc=False):
+        """A route's departures between two times, as ``rrule.between``"""
+        departures = self._departures[name]
+        i = departures.searchsorted(_as_datetime64(after),
+                                    side='left' if inc else 'right')
+        j = departures.searchsorted(_as_datetime64(before),
+                                    side='right' if inc else 'left')
+
+        return departures[i:max(i, j)]
+
+    ### Queries across routes
+    def merged_next_departures(self, dt, n=1, routes=None, inc=False):
+        """
+        The next ``n`` departures after ``dt`` across ``routes`` (by default
+        all of them), as ``(datetime, route)`` tuples in time order. Routes
+        departing at the same time are in the order given.
+        """
+        routes = self.routes if routes is None else list(routes)
+        return self._merge(routes, [self.next_departures(name, dt, n, inc)
+                                    for name in routes])[:n]
+
+    def merged_between(self, after, before, routes=None, inc=False):
+        """As ``merged_next_departures``, for departures between two times"""
+        routes = self.routes if routes is None else list(routes)
+        return self._merge(routes, [self.between(name, after, before, inc)
+                                    for name in routes])
+
+    def _merge(self, routes, departures):
+        if not routes:
+            return []
+
+        which = np.repeat(np.arange(len(routes)), [len(deps)
+                                                   for deps in departures])
+        times = np.concatenate(departures)
+        order = np.argsort(times, kind='stable')
+
+        return [(time, routes[i]) for time, i in
+                zip(times[order].tolist(), which[order].tolist())]
@@ -1,7 +1,9 @@
 import itertools as it
+import numpy as np
 import rr_answers as rra
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil.rrule import rrule, rrulestr, DAILY, MONTHLY, FR
 
 ### Exercise: Martin Luther King Day
 def test_mlk_day(mlk_day):
@@ -64,3 +66,150 @@ def test_final_schedule(bus_schedule):
 
     _test_bus_schedule(bus_schedule, exp_sched)
 
+
+def test_cached_rule_set(CachedRuleSet):
+    exp_sched = rra.get_final_schedule()
+    bus_schedule = CachedRuleSet(rra.get_final_schedule(),
+                                 max_occurrences=1000)
+
+    # Overlapping and repeated windows, some larger than the cache
+    windows = [(datetime(2020, 10, 1), 7), (datetime(2020, 10, 5), 7),
+               (datetime(2020, 9, 1), 150), (datetime(2020, 11, 3), 1),
+               (datetime(2020, 10, 5), 7)]
+    for start, days in windows:
+        for inc in (False, True):
+            between_args = (start, start.replace(hour=22, minute=37) +
+                            timedelta(days=days), inc)
+            assert (bus_schedule.between(*between_args) ==
+                    exp_sched.between(*between_args))
+
+    for dt in [datetime(2020, 11, 3), datetime(2020, 11, 3, 4, 32),
+               datetime(2019, 1, 1), datetime(2020, 10, 9, 22, 37)]:
+        for inc in (False, True):
+            assert bus_schedule.after(dt, inc) == exp_sched.after(dt, inc)
+            assert bus_schedule.before(dt, inc) == exp_sched.before(dt, inc)
+
+    # Ranges without buses are cached as empty segments, within the budget
+    bus_schedule = CachedRuleSet(rra.get_final_schedule(), max_occurrences=10)
+    for days in range(50):
+        night = datetime(2020, 10, 1, 2) + timedelta(days=days)
+        assert bus_schedule.between(night, night + timedelta(hours=2)) == []
+        assert bus_schedule.cached_segments <= 10
+
+    print("Passed!")
+
+
+def test_between_array(between_array):
+    rules = [rra.MLK_DAY, rra.get_weekday_schedule(), rra.get_final_schedule(),
+             rrule(MONTHLY, byweekday=FR(-1), byhour=(9, 17), interval=2,
+                   dtstart=datetime(2020, 10, 30, 9), count=20),
+             rrule(DAILY, bymonthday=(1, -1), until=datetime(2021, 6, 30),
+                   dtstart=datetime(2020, 9, 15, 12, 30))]
+
+    dt_limits = (datetime(2020, 9, 1), datetime(2021, 12, 31))
+    for rule in rules:
+        for inc in (False, True):
+            act = between_array(rule, *dt_limits, inc=inc)
+            exp = np.array(rule.between(*dt_limits, inc=inc),
+                           dtype='datetime64[us]')
+
+            assert np.array_equal(act, exp), f"{rule}: {act} != {exp}"
+
+    print("Passed!")
+
+
+def test_schedule(Schedule):
+    dt_limits = (datetime(2020, 9, 1), datetime(2020, 12, 31))
+
+    # Cancelling a whole day, as in get_no_election_schedule
+    bus_schedule = Schedule.from_ruleset(rra.get_evening_schedule())
+    bus_schedule.exclude_days(["2020-11-03"])
+    exp_sched = rra.get_no_election_schedule()
+    assert bus_schedule.between(*dt_limits) == exp_sched.between(*dt_limits)
+
+    # Bulk exdates and rdates, as arrays
+    exp_sched = rra.get_final_schedule()
+    bus_schedule = Schedule.from_ruleset(rra.get_evening_schedule())
+    bus_schedule.exdates(np.array(
+        exp_sched._exdate, dtype='datetime64[us]'))
+    bus_schedule.rdates(np.array(exp_sched._rdate, dtype='datetime64[us]'))
+    assert bus_schedule.between(*dt_limits) == exp_sched.between(*dt_limits)
+
+    for dt in [datetime(2020, 11, 3), datetime(2020, 11, 3, 4, 32)]:
+        assert bus_schedule.after(dt) == exp_sched.after(dt)
+        assert bus_schedule.before(dt) == exp_sched.before(dt)
+
+    # Overlapping ranges
+    bus_schedule = Schedule.from_ruleset(rra.get_evening_schedule())
+    bus_schedule.exclude_range(datetime(2020, 10, 1), datetime(2020, 10, 15))
+    bus_schedule.exclude_range(datetime(2020, 10, 10, 12),
+                               datetime(2020, 11, 1))
+    exp = [dt for dt in rra.get_evening_schedule().between(*dt_limits)
+           if not datetime(2020, 10, 1) <= dt < datetime(2020, 11, 1)]
+    assert bus_schedule.between(*dt_limits) == exp
+
+    print("Passed!")
+
+
+def test_departure_index(DepartureIndex):
+    routes = {"weekday": rra.get_weekday_schedule(),
+              "weekend": rra.get_weekend_schedule(),
+              "final": rra.get_final_schedule()}
+    index = DepartureIndex(routes, datetime(2020, 10, 1),
+                           datetime(2020, 12, 1))
+
+    dt = datetime(2020, 11, 2, 22, 37)
+    for inc in (False, True):
+        for name, rule in routes.items():
+            exp = [rule.after(dt, inc)]
+            while len(exp) < 3:
+                exp.append(rule.after(exp[-1]))
+
+            assert index.next_departures(name, dt, 3, inc).tolist() == exp
+
+            between_args = (dt, dt + timedelta(days=3), inc)
+            assert (index.between(name, *between_args).tolist() ==
+                    rule.between(*between_args))
+
+        exp = sorted((dt_exp, name) for name, rule in routes.items()
+                     for dt_exp in rule.between(dt, datetime(2020, 11, 4),
+                                                inc))
+        act = index.merged_between(dt, datetime(2020, 11, 4), inc=inc)
+        assert sorted(act) == exp
+        assert index.merged_next_departures(dt, 5, inc=inc) == act[:5]
+
+    # Only the changed route is expanded again
+    index.update("final", rra.get_no_election_schedule())
+    assert (index.next_departures("final", dt, 1).tolist() ==
+            [datetime(2020, 11, 4, 6, 37)])
+
+    print("Passed!")
+
+
+def test_expand_rules(expand_rules):
+    rules = [rra.MLK_DAY, rra.get_final_schedule(),
+             "DTSTART:20200105T090000\n"
+             "RRULE:FREQ=WEEKLY;BYDAY=MO,WE;COUNT=40",
+             "DTSTART:20200101T000000\n"
+             "RRULE:FREQ=MONTHLY;BYDAY=-1FR\n"
+             "EXDATE:20200131T000000"]
+
+    dt_limits = (datetime(2020, 1, 1), datetime(2021, 6, 1))
+    for inc in (False, True):
+        exp = [(rrulestr(rule) if isinstance(rule, str) else rule).between(
+            *dt_limits, inc=inc) for rule in rules]
+
+        for window in (None, timedelta(days=30)):
+            act = expand_rules(rules, *dt_limits, inc=inc, processes=2,
+                               window=window)
+            assert [values.tolist() for values in act] == exp
+
+    for window in (timedelta(0), timedelta(days=-1)):
+        try:
+            expand_rules(rules, *dt_limits, window=window)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"Failed to reject window={window!r}")
+
+    print("Passed!")